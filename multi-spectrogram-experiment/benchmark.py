@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""benchmark
+
+Reproducible timings for the multi-spectrogram pipeline, on synthetic audio and without network or Drive.
+
+ *   Generates NSynth-shaped clips (64000 samples at 16 kHz) from a fixed seed.
+ *   Times every audio_to_* feature function and concatenate_spectrograms_with_padding from prepare_samples.py.
+ *   Times one create_model train step (experiment_of_6_spectrograms.py) and the batched predict of the
+     10 family models (as in testing_of_6_spectrograms.py) at the real input shape of each spectrogram type.
+ *   Times the EMR / accuracy / classification report metrics.
+ *   Reports median time, throughput and peak RSS (sampled during the stage) per stage and writes them to
+     JSON; with --baseline the run is compared against a stored result and exits with status 1 on a
+     regression, or with status 2 when the two runs were made with different workload settings.
+
+Example:
+    python benchmark.py --output results.json
+    python benchmark.py --output new.json --baseline results.json --tolerance 0.2
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+from pipeline_profiler import MemorySampler
+from script_functions import load_script_functions
+
+"""define the global vars"""
+
+sample_rate = 16000
+num_audio_samples = 64000  # NSynth clips are 4 s at 16 kHz
+target_height = 300
+
+instrument_families = ['bass', 'brass', 'flute', 'guitar', 'keyboard', 'mallet', 'organ', 'reed', 'string', 'vocal']
+spectrogram_types = ['stft', 'log_mel', 'mfcc', 'chroma', 'spectral_contrast', 'tonnetz', 'all_combined_with_padding']
+
+feature_functions = load_script_functions('prepare_samples.py', [
+    'audio_to_spectrogram', 'audio_to_log_mel_spectrogram', 'audio_to_mfcc', 'audio_to_chroma',
+    'audio_to_spectral_contrast', 'audio_to_tonnetz', 'normalize_data', 'resize_spectrogram',
+    'concatenate_spectrograms_with_padding',
+])
+spectrogram_functions = {
+    'stft': feature_functions['audio_to_spectrogram'],
+    'log_mel': feature_functions['audio_to_log_mel_spectrogram'],
+    'mfcc': feature_functions['audio_to_mfcc'],
+    'chroma': feature_functions['audio_to_chroma'],
+    'spectral_contrast': feature_functions['audio_to_spectral_contrast'],
+    'tonnetz': feature_functions['audio_to_tonnetz']
+}
+
+"""synthetic data"""
+
+# Function to generate harmonic tones with an envelope and a little noise, shaped like NSynth notes
+def generate_audio(num_clips, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(num_audio_samples) / sample_rate
+    clips = np.zeros((num_clips, num_audio_samples), dtype=np.float32)
+    for i in range(num_clips):
+        f0 = rng.uniform(55, 1760)
+        for harmonic in range(1, 6):
+            clips[i] += rng.uniform(0.1, 1.0) / harmonic * np.sin(2 * np.pi * f0 * harmonic * t)
+        clips[i] *= np.exp(-t * rng.uniform(0.5, 3.0))
+        clips[i] += 0.01 * rng.standard_normal(num_audio_samples)
+    return clips / np.abs(clips).max(axis=1, keepdims=True)
+
+# Function to convert a clip the same way prepare_samples.py stored the per-type training data
+def prepare_spectrogram(spectrogram_type, audio):
+    spec = spectrogram_functions[spectrogram_type](audio)
+    if spectrogram_type not in ['stft']:
+        spec = feature_functions['resize_spectrogram'](spec, target_height)
+    return feature_functions['normalize_data'](spec)
+
+# Function to build one sample of every spectrogram type, giving the real model input shapes
+def prepare_features(audio):
+    features = {spectrogram_type: prepare_spectrogram(spectrogram_type, audio) for spectrogram_type in spectrogram_functions}
+    features['all_combined_with_padding'] = feature_functions['concatenate_spectrograms_with_padding'](
+        [features[spectrogram_type] for spectrogram_type in spectrogram_functions])
+    return features
+
+"""metrics under test"""
+
+# Exact Match Ratio as computed in the OpenMIC notebooks
+def exact_match_ratio(y_true, y_pred):
+    return np.mean([np.array_equal(y_true[i], y_pred[i]) for i in range(len(y_true))])
+
+"""timing"""
+
+# RSS is sampled while each stage runs, so a stage reports its own peak and not the
+# process-lifetime high-water mark that ru_maxrss gives
+memory_sampler = MemorySampler(interval=0.01)
+
+def time_stage(fn, items, repeats=5, warmup=1):
+    window = ('time_stage', time.perf_counter())
+    rss_start = memory_sampler.start_window(window)
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    rss_end, rss_peak = memory_sampler.end_window(window)
+    median = float(np.median(timings))
+    return {
+        'seconds_median': median,
+        'seconds_min': float(np.min(timings)),
+        'seconds_max': float(np.max(timings)),
+        'repeats': repeats,
+        'items': items,
+        'items_per_second': items / median if median > 0 else float('inf'),
+        'rss_start_mb': rss_start,
+        'rss_end_mb': rss_end,
+        'peak_rss_mb': rss_peak,
+    }
+
+"""results"""
+
+class BenchmarkRun:
+    def __init__(self, output_path, header):
+        self.output_path = output_path
+        self.header = header
+        self.results = {}
+
+    # Each stage is saved as soon as it finishes, and a stage that fails (e.g. OOM building the
+    # all_combined_with_padding models) is recorded as an error instead of losing the whole run
+    def record(self, name, measure):
+        try:
+            self.results[name] = measure()
+        except Exception as e:
+            print(f"{name} failed: {type(e).__name__}: {e}")
+            self.results[name] = {'error': f'{type(e).__name__}: {e}'}
+            gc.collect()
+        self.save()
+
+    def save(self):
+        tmp_path = self.output_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({**self.header, 'results': self.results}, f, indent=2)
+        os.replace(tmp_path, self.output_path)
+
+"""stages"""
+
+def benchmark_extraction(run, clips, repeats, warmup):
+    for spectrogram_type, spectrogram_function in spectrogram_functions.items():
+        name = spectrogram_function.__name__
+        print(f"Timing {name}")
+        run.record(f'extract/{name}', lambda: time_stage(
+            lambda: [spectrogram_function(audio) for audio in clips], len(clips), repeats, warmup))
+
+    per_clip_features = [prepare_features(audio) for audio in clips]
+    print("Timing concatenate_spectrograms_with_padding")
+    run.record('extract/concatenate_spectrograms_with_padding', lambda: time_stage(
+        lambda: [feature_functions['concatenate_spectrograms_with_padding'](
+            [features[spectrogram_type] for spectrogram_type in spectrogram_functions]) for features in per_clip_features],
+        len(clips), repeats, warmup))
+
+def benchmark_models(run, input_shapes, types, stages, batch_size, predict_samples, repeats, warmup, seed):
+    import tensorflow as tf
+    create_model = load_script_functions('experiment_of_6_spectrograms.py', ['create_model'])['create_model']
+    rng = np.random.default_rng(seed)
+
+    # The models are built inside the measured function so they are freed when the stage ends or fails
+    def measure_train_step(input_shape):
+        model = create_model(input_shape=input_shape)
+        x_batch = rng.standard_normal((batch_size,) + input_shape).astype(np.float32)
+        y_batch = rng.integers(0, 2, batch_size).astype(np.float32)
+        # warmup covers graph tracing, which is not part of the steady-state step time
+        return time_stage(lambda: model.train_on_batch(x_batch, y_batch), batch_size, repeats, max(warmup, 1))
+
+    def measure_predict(input_shape):
+        model_cache = {family: create_model(input_shape=input_shape) for family in instrument_families}
+        x_val = rng.standard_normal((predict_samples,) + input_shape).astype(np.float32)
+
+        def predict_all_families():
+            y_pred = np.zeros((x_val.shape[0], len(instrument_families)))
+            for label, family in enumerate(instrument_families):
+                y_pred[:, label] = model_cache[family].predict(x_val, batch_size=batch_size, verbose=0).flatten()
+            return y_pred
+
+        return time_stage(predict_all_families, predict_samples, repeats, max(warmup, 1))
+
+    for spectrogram_type in types:
+        input_shape = input_shapes[spectrogram_type] + (1,)
+
+        if 'train' in stages:
+            print(f"Timing train step for {spectrogram_type} {input_shape}")
+            tf.keras.backend.clear_session()
+            run.record(f'train_step/{spectrogram_type}', lambda: measure_train_step(input_shape))
+
+        if 'predict' in stages:
+            print(f"Timing 10-family predict for {spectrogram_type}")
+            tf.keras.backend.clear_session()
+            run.record(f'predict_10_families/{spectrogram_type}', lambda: measure_predict(input_shape))
+    tf.keras.backend.clear_session()
+
+def benchmark_metrics(run, num_samples, repeats, warmup, seed):
+    from sklearn.metrics import accuracy_score, classification_report, confusion_matrix
+
+    rng = np.random.default_rng(seed)
+    y_true_multi = rng.integers(0, 2, (num_samples, len(instrument_families)))
+    y_pred_multi = np.where(rng.random(y_true_multi.shape) < 0.9, y_true_multi, 1 - y_true_multi)
+    y_true = rng.integers(0, len(instrument_families), num_samples)
+    y_pred = np.where(rng.random(num_samples) < 0.8, y_true, rng.integers(0, len(instrument_families), num_samples))
+
+    print("Timing metrics")
+    run.record('metrics/exact_match_ratio', lambda: time_stage(
+        lambda: exact_match_ratio(y_true_multi, y_pred_multi), num_samples, repeats, warmup))
+    run.record('metrics/accuracy_score_multilabel', lambda: time_stage(
+        lambda: accuracy_score(y_true_multi, y_pred_multi), num_samples, repeats, warmup))
+    run.record('metrics/classification_report', lambda: time_stage(
+        lambda: classification_report(y_true, y_pred, target_names=instrument_families, zero_division=0),
+        num_samples, repeats, warmup))
+    run.record('metrics/confusion_matrix', lambda: time_stage(
+        lambda: confusion_matrix(y_true, y_pred), num_samples, repeats, warmup))
+
+"""baseline comparison"""
+
+# Settings that change the work a stage does; timings are only comparable when these match
+workload_settings = ['num_clips', 'batch_size', 'predict_samples', 'metric_samples', 'repeats', 'warmup', 'seed']
+
+def config_mismatches(current, baseline):
+    return {key: (baseline['config'].get(key), current['config'].get(key))
+            for key in workload_settings if baseline['config'].get(key) != current['config'].get(key)}
+
+def compare_with_baseline(current, baseline, tolerance):
+    regressions = []
+    print(f"\n{'stage':<52}{'baseline s':>12}{'current s':>12}{'ratio':>8}")
+    for stage, result in current['results'].items():
+        if 'error' in result:
+            print(f"{stage:<52}{'':>12}{'':>12}{'':>8}  FAILED")
+            regressions.append(stage)
+            continue
+        before_result = baseline['results'].get(stage)
+        if before_result is None or 'error' in before_result:
+            print(f"{stage:<52}{'-':>12}{result['seconds_median']:>12.4f}{'new':>8}")
+            continue
+        before = before_result['seconds_median']
+        ratio = result['seconds_median'] / before if before > 0 else float('inf')
+        flag = '  REGRESSION' if ratio > 1 + tolerance else ''
+        print(f"{stage:<52}{before:>12.4f}{result['seconds_median']:>12.4f}{ratio:>8.2f}{flag}")
+        if flag:
+            regressions.append(stage)
+    return regressions
+
+def environment_info():
+    info = {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+            'numpy': np.__version__}
+    for module_name in ['librosa', 'tensorflow', 'sklearn']:
+        try:
+            info[module_name] = __import__(module_name).__version__
+        except ImportError:
+            info[module_name] = None
+    return info
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark feature extraction, training, inference and metrics.')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', default=None, help='JSON from an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown before a stage counts as a regression')
+    parser.add_argument('--stages', default='extract,train,predict,metrics')
+    parser.add_argument('--spectrogram-types', default=','.join(spectrogram_types))
+    parser.add_argument('--num-clips', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--predict-samples', type=int, default=64)
+    parser.add_argument('--metric-samples', type=int, default=500)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    stages = args.stages.split(',')
+    types = args.spectrogram_types.split(',')
+    np.random.seed(args.seed)
+
+    clips = generate_audio(args.num_clips, args.seed)
+    input_shapes = {spectrogram_type: spec.shape for spectrogram_type, spec in prepare_features(clips[0]).items()}
+
+    run = BenchmarkRun(args.output, {
+        'environment': environment_info(),
+        'config': vars(args),
+        'input_shapes': {spectrogram_type: list(shape) for spectrogram_type, shape in input_shapes.items()},
+    })
+    if 'extract' in stages:
+        benchmark_extraction(run, clips, args.repeats, args.warmup)
+    if 'train' in stages or 'predict' in stages:
+        benchmark_models(run, input_shapes, types, stages, args.batch_size, args.predict_samples,
+                         args.repeats, args.warmup, args.seed)
+    if 'metrics' in stages:
+        benchmark_metrics(run, args.metric_samples, args.repeats, args.warmup, args.seed)
+    run.save()
+    current = {**run.header, 'results': run.results}
+
+    print(f"\n{'stage':<52}{'median s':>12}{'items/s':>12}{'peak RSS MB':>14}")
+    for stage, result in run.results.items():
+        if 'error' in result:
+            print(f"{stage:<52}  failed: {result['error']}")
+            continue
+        print(f"{stage:<52}{result['seconds_median']:>12.4f}{result['items_per_second']:>12.1f}{result['peak_rss_mb']:>14.1f}")
+    print(f"Benchmark results saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        mismatches = config_mismatches(current, baseline)
+        if mismatches:
+            for key, (before, now) in mismatches.items():
+                print(f"--{key.replace('_', '-')}: baseline {before}, current {now}")
+            print("Not comparing: rerun with the baseline's settings.")
+            sys.exit(2)
+        regressions = compare_with_baseline(current, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} stage(s) failed or slower than baseline by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+        print("No regressions against baseline.")
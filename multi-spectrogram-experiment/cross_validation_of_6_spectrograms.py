@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""cross-validation-of-6-spectrograms
+
+Stratified k-fold comparison of the spectrogram types, instead of the single [:150] / [-50:] split.
+
+ *   Generates stratified folds over the 10 x 200 samples once and saves them, so every spectrogram type
+     (and every rerun) is evaluated on exactly the same folds.
+ *   Loads each spectrogram type's feature arrays once into shared memory; fold workers attach to it
+     instead of re-reading the .npy files from Drive.
+ *   Trains the folds in parallel worker processes, each limited to a few TensorFlow threads, with the
+     same per-family recipe as experiment_of_6_spectrograms.py (fit_family_model) and the same
+     prediction step as testing_of_6_spectrograms.py (predict_family_probabilities).
+ *   Reports mean accuracy and macro F1 with a 95% confidence interval per spectrogram type, and mean F1
+     with a 95% confidence interval per instrument family.
+"""
+
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy import stats
+from sklearn.metrics import accuracy_score, f1_score
+from sklearn.model_selection import StratifiedKFold
+
+from script_functions import load_script_functions
+
+"""define the global vars"""
+
+# Directory paths
+base_dir = '/content/drive/My Drive/200-each-instrument/'
+combined_save_dir = os.path.join(base_dir, 'all_combined_with_padding')
+output_dir = '/content/drive/My Drive/output-multi-gram/'
+cv_dir = os.path.join(output_dir, 'cross_validation')
+
+# Instrument families, the position is the class label
+instrument_families = ['bass', 'brass', 'flute', 'guitar', 'keyboard', 'mallet', 'organ', 'reed', 'string', 'vocal']
+family_labels = {family: label for label, family in enumerate(instrument_families)}
+
+# Spectrogram types
+spectrogram_types = ['stft', 'log_mel', 'mfcc', 'chroma', 'spectral_contrast', 'tonnetz', 'all_combined_with_padding']
+
+n_splits = 5
+n_workers = 2           # fold processes running at the same time
+threads_per_worker = 4  # TensorFlow intra-op threads per process
+epochs = 1000
+seed = 42
+
+"""load data"""
+
+def load_data(family, spectrogram_type=None):
+    if spectrogram_type:
+      if spectrogram_type !="all_combined_with_padding":
+        file_path = os.path.join(base_dir, spectrogram_type, family, f'{family}_{spectrogram_type}.npy')
+      else:
+        file_path = os.path.join(combined_save_dir, f'{family}_combined.npy')
+    else:
+        file_path = os.path.join(base_dir, f'{family}.npy')
+    return np.load(file_path)
+
+# Function to copy one spectrogram type for all families into a shared memory block
+def load_to_shared_memory(spectrogram_type):
+    arrays = [load_data(family, spectrogram_type).astype(np.float32) for family in instrument_families]
+    labels = np.concatenate([np.full(len(array), family_labels[family]) for family, array in zip(instrument_families, arrays)])
+    shape = (sum(len(array) for array in arrays),) + arrays[0].shape[1:]
+
+    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(np.float32).itemsize)
+    x_shared = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+    np.concatenate(arrays, axis=0, out=x_shared)
+    return shm, shape, labels
+
+"""folds"""
+
+# Function to create the stratified folds once and reuse them for every spectrogram type and rerun
+def load_or_create_folds(labels, folds_path):
+    if os.path.exists(folds_path):
+        with open(folds_path) as f:
+            folds = json.load(f)
+        if folds['n_samples'] == len(labels) and folds['n_splits'] == n_splits and folds['seed'] == seed:
+            return [np.array(test_idx) for test_idx in folds['test_indices']]
+
+    splitter = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=seed)
+    test_indices = [test_idx for _, test_idx in splitter.split(np.zeros(len(labels)), labels)]
+    with open(folds_path, 'w') as f:
+        json.dump({'n_samples': len(labels), 'n_splits': n_splits, 'seed': seed,
+                   'test_indices': [test_idx.tolist() for test_idx in test_indices]}, f)
+    return test_indices
+
+"""fold worker"""
+
+worker_state = {}
+
+# Runs once in every worker process, before TensorFlow is imported
+def init_worker(threads):
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    os.environ['TF_NUM_INTRAOP_THREADS'] = str(threads)
+    os.environ['TF_NUM_INTEROP_THREADS'] = '1'
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    for gpu in tf.config.list_physical_devices('GPU'):
+        tf.config.experimental.set_memory_growth(gpu, True)
+
+    worker_state.update(load_script_functions('experiment_of_6_spectrograms.py', ['create_model', 'fit_family_model', 'clear_gpu_memory']))
+    worker_state.update(load_script_functions('testing_of_6_spectrograms.py', ['predict_family_probabilities']))
+
+# Attach to a shared block once per spectrogram type instead of once per fold
+def attach_shared(shm_name, shape):
+    if worker_state.get('shm_name') != shm_name:
+        if 'shm' in worker_state:
+            worker_state['shm'].close()
+        worker_state['shm'] = shared_memory.SharedMemory(name=shm_name)
+        worker_state['shm_name'] = shm_name
+    return np.ndarray(shape, dtype=np.float32, buffer=worker_state['shm'].buf)
+
+def run_fold(spectrogram_type, fold, shm_name, shape, labels, train_idx, test_idx, epochs, fold_seed):
+    x_all = attach_shared(shm_name, shape)
+    fit_family_model = worker_state['fit_family_model']
+    predict_family_probabilities = worker_state['predict_family_probabilities']
+    clear_gpu_memory = worker_state['clear_gpu_memory']
+
+    start = time.time()
+    x_train = np.expand_dims(x_all[train_idx], axis=-1)
+    x_val = np.expand_dims(x_all[test_idx], axis=-1)
+
+    # One-vs-all: positives are this family's training samples, negatives every other family's.
+    # fit_family_model holds out a stratified validation split, seeded per fold
+    model_cache = {}
+    for family, label in family_labels.items():
+        y_train = (labels[train_idx] == label).astype(np.float32)
+        model_cache[family], _ = fit_family_model(x_train, y_train, epochs=epochs, seed=fold_seed)
+
+    y_pred = predict_family_probabilities(model_cache, x_val, family_labels)
+    clear_gpu_memory(model_cache, x_train, x_val)
+
+    return {'spectrogram_type': spectrogram_type, 'fold': fold, 'y_true': labels[test_idx],
+            'y_pred': y_pred, 'seconds': time.time() - start}
+
+"""summary"""
+
+def mean_ci(values, confidence=0.95):
+    values = np.asarray(values, dtype=float)
+    mean = float(values.mean())
+    if len(values) < 2:
+        return mean, float('nan')
+    half_width = stats.t.ppf((1 + confidence) / 2, len(values) - 1) * values.std(ddof=1) / np.sqrt(len(values))
+    return mean, float(half_width)
+
+def summarize(fold_results):
+    summary = {}
+    for spectrogram_type in spectrogram_types:
+        results = sorted((r for r in fold_results if r['spectrogram_type'] == spectrogram_type), key=lambda r: r['fold'])
+        if not results:
+            continue
+        accuracies, macro_f1s, family_f1s = [], [], []
+        for r in results:
+            y_pred_labels = np.argmax(r['y_pred'], axis=1)
+            accuracies.append(accuracy_score(r['y_true'], y_pred_labels))
+            macro_f1s.append(f1_score(r['y_true'], y_pred_labels, average='macro'))
+            family_f1s.append(f1_score(r['y_true'], y_pred_labels, labels=list(range(len(instrument_families))),
+                                       average=None, zero_division=0))
+        family_f1s = np.array(family_f1s)
+        summary[spectrogram_type] = {
+            'folds': len(results),
+            'accuracy': mean_ci(accuracies),
+            'macro_f1': mean_ci(macro_f1s),
+            'family_f1': {family: mean_ci(family_f1s[:, label]) for family, label in family_labels.items()},
+        }
+    return summary
+
+def print_summary(summary):
+    print(f"\n{'spectrogram type':<28}{'folds':>6}{'accuracy (95% CI)':>24}{'macro F1 (95% CI)':>24}")
+    for spectrogram_type, s in summary.items():
+        print(f"{spectrogram_type:<28}{s['folds']:>6}{s['accuracy'][0]:>15.3f} ± {s['accuracy'][1]:.3f}"
+              f"{s['macro_f1'][0]:>15.3f} ± {s['macro_f1'][1]:.3f}")
+
+    print(f"\nPer-family F1 (mean ± 95% CI)")
+    print(f"{'family':<10}" + ''.join(f"{spectrogram_type[:16]:>18}" for spectrogram_type in summary))
+    for family in instrument_families:
+        print(f"{family:<10}" + ''.join(f"{s['family_f1'][family][0]:>10.3f} ± {s['family_f1'][family][1]:.3f}"
+                                         for s in summary.values()))
+
+"""run"""
+
+if __name__ == '__main__':
+    from google.colab import drive
+
+    # Mount Google Drive
+    drive.mount('/content/drive')
+    os.makedirs(cv_dir, exist_ok=True)
+
+    fold_results = []
+    # spawn: workers must not inherit a forked TensorFlow runtime
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=context,
+                             initializer=init_worker, initargs=(threads_per_worker,)) as pool:
+        for spectrogram_type in spectrogram_types:
+            print(f"Cross-validating spectrogram type: {spectrogram_type}")
+            shm, shape, labels = load_to_shared_memory(spectrogram_type)
+            try:
+                test_indices = load_or_create_folds(labels, os.path.join(cv_dir, 'folds.json'))
+                futures = []
+                for fold, test_idx in enumerate(test_indices):
+                    train_idx = np.setdiff1d(np.arange(len(labels)), test_idx)
+                    futures.append(pool.submit(run_fold, spectrogram_type, fold, shm.name, shape, labels,
+                                               train_idx, test_idx, epochs, seed + fold))
+                for future in as_completed(futures):
+                    result = future.result()
+                    fold_results.append(result)
+                    np.savez(os.path.join(cv_dir, f"{spectrogram_type}_fold{result['fold']}_predictions.npz"),
+                             y_true=result['y_true'], y_pred=result['y_pred'])
+                    print(f"{spectrogram_type} fold {result['fold']} finished in {result['seconds']:.0f}s")
+            finally:
+                shm.close()
+                shm.unlink()
+
+    summary = summarize(fold_results)
+    with open(os.path.join(cv_dir, 'cross_validation_summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    print_summary(summary)
+    print(f"Cross-validation completed and results saved to {cv_dir}")
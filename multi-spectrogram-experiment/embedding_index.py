@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+"""embedding-index
+
+Nearest-neighbour search over the 256-d embeddings the family models learn in their Dense(256) layer.
+
+ *   build: runs the trunk of one trained family model (everything up to Dense(256), the same cut
+     create_intermediate_model makes in the validation notebook) over every saved sample of a spectrogram
+     type in batches, and stores the L2-normalised embeddings as one float16 matrix plus an IVF index.
+ *   query: embeds a new clip (audio file or precomputed spectrogram .npy) and returns the most similar
+     samples and a kNN family vote, without running the 10 one-vs-all heads.
+ *   benchmark: index build time, single-query latency (p50/p99), batch throughput, recall@k against brute
+     force and kNN accuracy, on held-out samples of the stored embeddings or on synthetic clusters.
+
+The index is an inverted file (IVF): spherical k-means splits the embeddings into n_lists clusters and a
+query only scores the vectors in its nprobe closest clusters. Similarity is cosine (dot product of the
+normalised vectors).
+
+Example:
+    python embedding_index.py build --spectrogram-type log_mel --trunk-family bass
+    python embedding_index.py query --spectrogram-type log_mel --trunk-family bass --audio clip.wav
+    python embedding_index.py benchmark --spectrogram-type log_mel --trunk-family bass --nprobe 1,4,8,16
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+import inference_server
+from inference_server import extract_features, fit_to_input_shape
+
+"""define the global vars"""
+
+# Directory paths
+base_dir = '/content/drive/My Drive/200-each-instrument/'
+combined_save_dir = os.path.join(base_dir, 'all_combined_with_padding')
+output_dir = '/content/drive/My Drive/output-multi-gram/'
+models_dir = os.path.join(output_dir, 'models')
+embeddings_dir = os.path.join(output_dir, 'embeddings')
+
+# Instrument families, the position is the class label
+instrument_families = ['bass', 'brass', 'flute', 'guitar', 'keyboard', 'mallet', 'organ', 'reed', 'string', 'vocal']
+
+# Spectrogram types
+spectrogram_types = ['stft', 'log_mel', 'mfcc', 'chroma', 'spectral_contrast', 'tonnetz', 'all_combined_with_padding']
+
+embedding_units = 256
+
+"""load data"""
+
+def load_data(family, spectrogram_type=None):
+    if spectrogram_type:
+      if spectrogram_type !="all_combined_with_padding":
+        file_path = os.path.join(base_dir, spectrogram_type, family, f'{family}_{spectrogram_type}.npy')
+      else:
+        file_path = os.path.join(combined_save_dir, f'{family}_combined.npy')
+    else:
+        file_path = os.path.join(base_dir, f'{family}.npy')
+    return np.load(file_path)
+
+def embeddings_path(spectrogram_type, trunk_family):
+    return os.path.join(embeddings_dir, f'{spectrogram_type}_{trunk_family}_embeddings.npz')
+
+def index_path(spectrogram_type, trunk_family):
+    return os.path.join(embeddings_dir, f'{spectrogram_type}_{trunk_family}_ivf.npz')
+
+"""embeddings"""
+
+# Function to cut a family model after its Dense(256) layer
+def create_embedding_model(loaded_model, layer_name=None):
+    import tensorflow as tf
+
+    if layer_name is None:
+        dense_layers = [layer.name for layer in loaded_model.layers
+                        if isinstance(layer, tf.keras.layers.Dense) and layer.units == embedding_units]
+        if not dense_layers:
+            raise ValueError(f"model has no Dense({embedding_units}) layer")
+        layer_name = dense_layers[0]
+    return tf.keras.Model(inputs=loaded_model.inputs, outputs=loaded_model.get_layer(layer_name).output)
+
+def normalize_embeddings(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+# Function to embed (N, H, W) spectrograms in batches into a normalised float16 (N, 256) matrix
+def extract_embeddings(embedding_model, x_data, batch_size=256):
+    embeddings = np.empty((len(x_data), embedding_model.output_shape[-1]), dtype=np.float16)
+    for start in range(0, len(x_data), batch_size):
+        x_batch = np.expand_dims(np.asarray(x_data[start:start + batch_size], dtype=np.float32), axis=-1)
+        embeddings[start:start + len(x_batch)] = normalize_embeddings(embedding_model.predict_on_batch(x_batch))
+    return embeddings
+
+def build_embeddings(spectrogram_type, trunk_family, batch_size=256):
+    from tensorflow.keras.models import load_model
+
+    model = load_model(os.path.join(models_dir, spectrogram_type, f'{spectrogram_type}_{trunk_family}.h5'))
+    embedding_model = create_embedding_model(model)
+
+    embeddings, labels, keys = [], [], []
+    for label, family in enumerate(instrument_families):
+        x_data = load_data(family, spectrogram_type)
+        embeddings.append(extract_embeddings(embedding_model, x_data, batch_size))
+        labels.append(np.full(len(x_data), label))
+        keys.extend(f'{family}/{i}' for i in range(len(x_data)))
+        print(f"Embedded {len(x_data)} {family} samples")
+    return np.concatenate(embeddings), np.concatenate(labels), np.array(keys), embedding_model
+
+def save_embeddings(path, embeddings, labels, keys):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    np.savez(path, embeddings=embeddings, labels=labels, keys=keys)
+
+def load_embeddings(path):
+    data = np.load(path)
+    return data['embeddings'], data['labels'], data['keys']
+
+"""search"""
+
+# Spherical k-means on the normalised embeddings; an empty cluster is reseeded with a random vector
+def spherical_kmeans(x, n_clusters, iterations=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(x @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, x)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        empty = counts == 0
+        sums[empty] = x[rng.choice(len(x), int(empty.sum()), replace=False)]
+        centroids = normalize_embeddings(sums)
+    return centroids
+
+def top_k(scores, k):
+    # Unordered top k with argpartition, then sorted by score
+    k = min(k, scores.shape[-1])
+    idx = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    order = np.argsort(-np.take_along_axis(scores, idx, axis=-1), axis=-1)
+    idx = np.take_along_axis(idx, order, axis=-1)
+    return idx, np.take_along_axis(scores, idx, axis=-1)
+
+# Exact search; pass float32 embeddings, a float16 matrix is converted on every call
+def brute_force_search(embeddings, queries, k=10, batch_size=1024):
+    queries = normalize_embeddings(np.atleast_2d(queries))
+    ids = np.empty((len(queries), min(k, len(embeddings))), dtype=np.int64)
+    scores = np.empty(ids.shape, dtype=np.float32)
+    for start in range(0, len(queries), batch_size):
+        batch_scores = queries[start:start + batch_size] @ embeddings.T
+        ids[start:start + batch_size], scores[start:start + batch_size] = top_k(batch_scores, k)
+    return ids, scores
+
+class IVFIndex:
+    def __init__(self, n_lists=32, nprobe=4, kmeans_iterations=20, train_size=None, seed=0):
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.kmeans_iterations = kmeans_iterations
+        self.train_size = train_size
+        self.seed = seed
+
+    def build(self, embeddings):
+        x = np.asarray(embeddings, dtype=np.float32)
+        self.n_lists = min(self.n_lists, len(x))
+        # k-means only needs a sample; the default is ~256 vectors per list
+        train_size = min(len(x), self.train_size or 256 * self.n_lists)
+        sample = x[np.random.default_rng(self.seed).choice(len(x), train_size, replace=False)]
+        self.centroids = spherical_kmeans(sample, self.n_lists, self.kmeans_iterations, self.seed)
+        assignment = np.argmax(x @ self.centroids.T, axis=1)
+        self.order = np.argsort(assignment, kind='stable')
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=self.n_lists))])
+        self.attach(embeddings)
+        return self
+
+    def attach(self, embeddings):
+        # Vectors of one list are stored next to each other, so a probe reads contiguous slices;
+        # they are kept as float32 in memory, only the saved matrix is float16
+        self.vectors = np.asarray(embeddings, dtype=np.float32)[self.order]
+
+    def search(self, queries, k=10, nprobe=None):
+        nprobe = min(nprobe or self.nprobe, self.n_lists)
+        queries = normalize_embeddings(np.atleast_2d(queries))
+        probe_lists, _ = top_k(queries @ self.centroids.T, nprobe)
+        if len(queries) == 1:
+            return self.search_one(queries[0], probe_lists[0], k)
+
+        # Group the (query, probed list) pairs by list, so every inverted list is scored once per batch
+        # against all the queries that probe it; each list keeps its own top k per query in a candidate slot
+        candidate_ids = np.full((len(queries), nprobe, k), -1, dtype=np.int64)
+        candidate_scores = np.full((len(queries), nprobe, k), -np.inf, dtype=np.float32)
+        pair_lists = probe_lists.ravel()
+        pair_order = np.argsort(pair_lists, kind='stable')
+        pair_queries, pair_slots = np.divmod(pair_order, nprobe)
+        lists, group_starts = np.unique(pair_lists[pair_order], return_index=True)
+        for l, group in zip(lists, np.split(np.arange(len(pair_order)), group_starts[1:])):
+            start, stop = self.offsets[l], self.offsets[l + 1]
+            if stop == start:
+                continue
+            qs, slots = pair_queries[group], pair_slots[group]
+            best, best_scores = top_k(queries[qs] @ self.vectors[start:stop].T, k)
+            candidate_ids[qs[:, None], slots[:, None], np.arange(best.shape[1])] = self.order[start + best]
+            candidate_scores[qs[:, None], slots[:, None], np.arange(best.shape[1])] = best_scores
+
+        # Merge the candidates of all probed lists; slots of short or empty lists stay -1 / -inf
+        candidate_ids = candidate_ids.reshape(len(queries), -1)
+        best, scores = top_k(candidate_scores.reshape(len(queries), -1), k)
+        ids = np.take_along_axis(candidate_ids, best, axis=1)
+        ids[np.isneginf(scores)] = -1
+        return ids, scores
+
+    # A single query needs no grouping: score its probed lists together and take one top k
+    def search_one(self, query, lists, k):
+        ids = np.full((1, k), -1, dtype=np.int64)
+        scores = np.full((1, k), -np.inf, dtype=np.float32)
+        rows = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in lists])
+        if len(rows):
+            best, best_scores = top_k(np.concatenate([self.vectors[self.offsets[l]:self.offsets[l + 1]] @ query for l in lists]), k)
+            ids[0, :len(best)] = self.order[rows[best]]
+            scores[0, :len(best)] = best_scores
+        return ids, scores
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        np.savez(path, centroids=self.centroids, order=self.order, offsets=self.offsets,
+                 params=json.dumps({'n_lists': self.n_lists, 'nprobe': self.nprobe,
+                                    'kmeans_iterations': self.kmeans_iterations, 'seed': self.seed}))
+
+    @classmethod
+    def load(cls, path, embeddings):
+        data = np.load(path)
+        index = cls(**json.loads(str(data['params'])))
+        index.centroids, index.order, index.offsets = data['centroids'], data['order'], data['offsets']
+        index.attach(embeddings)
+        return index
+
+# Function to vote the family of each query from its neighbours, weighted by similarity
+def knn_classify(neighbour_ids, neighbour_scores, labels, n_classes=len(instrument_families)):
+    votes = np.zeros((len(neighbour_ids), n_classes), dtype=np.float32)
+    valid = neighbour_ids >= 0
+    rows = np.broadcast_to(np.arange(len(neighbour_ids))[:, None], neighbour_ids.shape)
+    np.add.at(votes, (rows[valid], labels[neighbour_ids[valid]]), np.maximum(neighbour_scores[valid], 0))
+    return votes
+
+def recall_at_k(approx_ids, exact_ids):
+    hits = [len(np.intersect1d(a[a >= 0], e)) / len(e) for a, e in zip(approx_ids, exact_ids)]
+    return float(np.mean(hits))
+
+"""benchmark"""
+
+# Function to generate normalised float16 embeddings around n_classes cluster centres, for running without Drive
+def generate_embeddings(num_samples, n_classes=len(instrument_families), dim=embedding_units, spread=0.6, seed=0):
+    rng = np.random.default_rng(seed)
+    centres = np.maximum(rng.normal(size=(n_classes, dim)), 0)
+    labels = rng.integers(0, n_classes, num_samples)
+    embeddings = np.maximum(centres[labels] + spread * rng.normal(size=(num_samples, dim)), 0)
+    return normalize_embeddings(embeddings).astype(np.float16), labels
+
+def query_latencies_ms(search, queries):
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        search(query[np.newaxis])
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {'p50': float(np.percentile(latencies, 50)), 'p99': float(np.percentile(latencies, 99))}
+
+def batch_queries_per_second(search, queries):
+    start = time.perf_counter()
+    search(queries)
+    return len(queries) / (time.perf_counter() - start)
+
+# Hold out num_queries samples as queries, index the rest and compare every nprobe against brute force
+def benchmark_index(embeddings, labels, num_queries=200, k=10, n_lists=32, nprobes=(1, 2, 4, 8, 16), seed=0):
+    rng = np.random.default_rng(seed)
+    is_query = np.zeros(len(embeddings), dtype=bool)
+    is_query[rng.choice(len(embeddings), min(num_queries, len(embeddings) // 2), replace=False)] = True
+    database, database_labels = embeddings[~is_query], labels[~is_query]
+    database_f32 = database.astype(np.float32)
+    queries, query_labels = embeddings[is_query].astype(np.float32), labels[is_query]
+
+    start = time.perf_counter()
+    index = IVFIndex(n_lists=n_lists, seed=seed).build(database)
+    build_seconds = time.perf_counter() - start
+
+    exact_ids, exact_scores = brute_force_search(database_f32, queries, k)
+    brute_force = {
+        'latency_ms': query_latencies_ms(lambda q: brute_force_search(database_f32, q, k), queries),
+        'batch_queries_per_second': batch_queries_per_second(lambda q: brute_force_search(database_f32, q, k), queries),
+        'knn_accuracy': float(np.mean(np.argmax(knn_classify(exact_ids, exact_scores, database_labels), axis=1) == query_labels)),
+    }
+
+    ivf = {}
+    for nprobe in nprobes:
+        ids, scores = index.search(queries, k, nprobe)
+        ivf[nprobe] = {
+            'latency_ms': query_latencies_ms(lambda q: index.search(q, k, nprobe), queries),
+            'batch_queries_per_second': batch_queries_per_second(lambda q: index.search(q, k, nprobe), queries),
+            f'recall@{k}': recall_at_k(ids, exact_ids),
+            'knn_accuracy': float(np.mean(np.argmax(knn_classify(ids, scores, database_labels), axis=1) == query_labels)),
+        }
+
+    return {
+        'database_size': int(len(database)), 'num_queries': int(len(queries)), 'k': k, 'n_lists': index.n_lists,
+        'embedding_mb': database.nbytes / (1024 * 1024), 'build_seconds': build_seconds,
+        'brute_force': brute_force, 'ivf': ivf,
+    }
+
+def print_benchmark(results):
+    k = results['k']
+    print(f"\n{results['database_size']} vectors ({results['embedding_mb']:.1f} MB), {results['num_queries']} queries, "
+          f"{results['n_lists']} lists, build {results['build_seconds']:.3f}s")
+    print(f"{'search':<16}{'p50 ms':>10}{'p99 ms':>10}{'batch q/s':>12}{f'recall@{k}':>12}{'kNN acc':>10}")
+    bf = results['brute_force']
+    print(f"{'brute force':<16}{bf['latency_ms']['p50']:>10.3f}{bf['latency_ms']['p99']:>10.3f}"
+          f"{bf['batch_queries_per_second']:>12.0f}{1.0:>12.3f}{bf['knn_accuracy']:>10.3f}")
+    for nprobe, r in results['ivf'].items():
+        print(f"{f'ivf nprobe={nprobe}':<16}{r['latency_ms']['p50']:>10.3f}{r['latency_ms']['p99']:>10.3f}"
+              f"{r['batch_queries_per_second']:>12.0f}{r[f'recall@{k}']:>12.3f}{r['knn_accuracy']:>10.3f}")
+
+"""run"""
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Embedding index for similar-sound search and kNN family triage.')
+    parser.add_argument('command', choices=['build', 'query', 'benchmark'])
+    parser.add_argument('--spectrogram-type', default='log_mel', choices=spectrogram_types)
+    parser.add_argument('--trunk-family', default='bass', choices=instrument_families,
+                        help='family model whose Dense(256) layer provides the embeddings')
+    parser.add_argument('--base-dir', default=base_dir)
+    parser.add_argument('--output-dir', default=output_dir)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--n-lists', type=int, default=32)
+    parser.add_argument('--nprobe', default='4', help='lists to probe; a comma separated list for benchmark')
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--audio', default=None, help='query: audio file to embed (resampled to 16 kHz)')
+    parser.add_argument('--features', default=None, help='query: precomputed spectrogram .npy')
+    parser.add_argument('--synthetic', type=int, default=0, help='benchmark: use this many synthetic embeddings instead')
+    parser.add_argument('--num-queries', type=int, default=200)
+    parser.add_argument('--results', default=None, help='benchmark: write the results to this JSON file')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    base_dir, output_dir = args.base_dir, args.output_dir
+    combined_save_dir = os.path.join(base_dir, 'all_combined_with_padding')
+    models_dir = inference_server.models_dir = os.path.join(output_dir, 'models')
+    embeddings_dir = os.path.join(output_dir, 'embeddings')
+    nprobes = [int(n) for n in args.nprobe.split(',')]
+
+    if args.command == 'build':
+        start = time.perf_counter()
+        embeddings, labels, keys, _ = build_embeddings(args.spectrogram_type, args.trunk_family, args.batch_size)
+        extract_seconds = time.perf_counter() - start
+        save_embeddings(embeddings_path(args.spectrogram_type, args.trunk_family), embeddings, labels, keys)
+
+        start = time.perf_counter()
+        index = IVFIndex(n_lists=args.n_lists, nprobe=nprobes[0], seed=args.seed).build(embeddings)
+        index.save(index_path(args.spectrogram_type, args.trunk_family))
+        print(f"Embedded {len(embeddings)} samples in {extract_seconds:.1f}s ({embeddings.nbytes / 1024:.0f} KB float16), "
+              f"built {index.n_lists}-list index in {time.perf_counter() - start:.2f}s")
+        print(f"Saved to {embeddings_dir}")
+
+    elif args.command == 'query':
+        from tensorflow.keras.models import load_model
+
+        embeddings, labels, keys = load_embeddings(embeddings_path(args.spectrogram_type, args.trunk_family))
+        index = IVFIndex.load(index_path(args.spectrogram_type, args.trunk_family), embeddings)
+        model = load_model(os.path.join(models_dir, args.spectrogram_type, f'{args.spectrogram_type}_{args.trunk_family}.h5'))
+        embedding_model = create_embedding_model(model)
+
+        if args.features:
+            features = np.load(args.features)
+        elif args.audio:
+            import librosa
+            audio, sr = librosa.load(args.audio, sr=16000)
+            features = extract_features(args.spectrogram_type, audio, sr)
+        else:
+            raise SystemExit('query needs --audio or --features')
+        features = fit_to_input_shape(features, tuple(embedding_model.input_shape[1:3]))
+
+        start = time.perf_counter()
+        query = extract_embeddings(embedding_model, features[np.newaxis])
+        ids, scores = index.search(query, args.k, nprobes[0])
+        votes = knn_classify(ids, scores, labels)[0]
+        print(f"Query took {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        print(f"\nMost similar samples ({args.spectrogram_type}, {args.trunk_family} trunk):")
+        for i, score in zip(ids[0], scores[0]):
+            if i >= 0:
+                print(f"  {keys[i]:<20} similarity {score:.3f}")
+        print(f"\nkNN family vote: {instrument_families[int(np.argmax(votes))]}")
+        for family, vote in sorted(zip(instrument_families, votes / max(votes.sum(), 1e-12)), key=lambda v: -v[1]):
+            if vote > 0:
+                print(f"  {family:<10}{vote:.2f}")
+
+    else:
+        if args.synthetic:
+            embeddings, labels = generate_embeddings(args.synthetic, seed=args.seed)
+        else:
+            embeddings, labels, _ = load_embeddings(embeddings_path(args.spectrogram_type, args.trunk_family))
+        results = benchmark_index(embeddings, labels, args.num_queries, args.k, args.n_lists, nprobes, args.seed)
+        print_benchmark(results)
+        if args.results:
+            with open(args.results, 'w') as f:
+                json.dump(results, f, indent=2)
+            print(f"Benchmark results saved to {args.results}")
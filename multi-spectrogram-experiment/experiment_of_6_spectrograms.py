@@ -17,8 +17,11 @@ import matplotlib.pyplot as plt
 from tensorflow.keras.backend import clear_session
 from google.colab import drive
 import gc
+import json
 from tensorflow.keras.callbacks import EarlyStopping, ReduceLROnPlateau
 from tensorflow.keras.optimizers import Adam
+from sklearn.model_selection import train_test_split
+from pipeline_profiler import RunTrace
 
 """Mount google drive"""
 
@@ -34,6 +37,13 @@ combined_save_dir = os.path.join(base_dir, 'all_combined_with_padding')
 # New base directory for saving models and metrics
 output_dir = '/content/drive/My Drive/output-multi-gram/'
 
+# Per-stage timing trace (JSONL in output_dir/traces); set profile_mode to 'cprofile' or 'tf' to also capture
+# profiles, and profile_stages to e.g. ['model.fit'] to profile only that stage
+profile_mode = None
+profile_stages = None
+trace = RunTrace('experiment_of_6_spectrograms', trace_dir=os.path.join(output_dir, 'traces'),
+                 profile=profile_mode, profile_stages=profile_stages)
+
 """load data
 
 """
@@ -86,6 +96,42 @@ def clear_gpu_memory(*args):
     gc.collect()
     clear_session()
 
+# Function to build and fit one family's binary classifier
+def fit_family_model(x_train, y_train, epochs=1000, seed=42):
+    model = create_model(input_shape=x_train[0].shape)
+
+    # x_train is ordered by family and validation_split would take the last 30% before shuffling,
+    # leaving the last families with no training samples; split stratified on the label instead
+    x_fit, x_val, y_fit, y_val = train_test_split(x_train, y_train, test_size=0.3, stratify=y_train, random_state=seed)
+
+    # Assuming `model` is already defined and compiled
+    # Adjust patience for early stopping and learning rate reduction
+    early_stopping = EarlyStopping(monitor='val_loss', patience=300, restore_best_weights=True)
+    reduce_lr = ReduceLROnPlateau(monitor='val_loss', patience=150, factor=0.5, min_lr=1e-7)
+
+    history = model.fit(x_fit, y_fit, validation_data=(x_val, y_val), epochs=epochs, callbacks=[early_stopping, reduce_lr])
+    return model, history
+
+# All training curves in one file, {spectrogram_type: {family: {'loss': [...], 'accuracy': [...]}}},
+# so the plots can be made without reading a text file per curve
+training_metrics_path = os.path.join(output_dir, 'metrics', 'training_metrics.json')
+
+# Function to add one model's curves to the consolidated metrics file
+def save_training_metrics(spectrogram_type, family, history):
+    metrics = {}
+    if os.path.exists(training_metrics_path):
+        with open(training_metrics_path) as f:
+            metrics = json.load(f)
+    metrics.setdefault(spectrogram_type, {})[family] = {
+        'loss': [float(v) for v in history.history['loss']],
+        'accuracy': [float(v) for v in history.history['accuracy']],
+    }
+    # Write to a temporary file first so an interrupted run never leaves a half-written file
+    tmp_path = training_metrics_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(metrics, f)
+    os.replace(tmp_path, training_metrics_path)
+
 # Training function
 def train_model_for_spectrogram_type(spectrogram_type, instrument_families):
     print(f"Training for spectrogram type: {spectrogram_type}")
@@ -96,33 +142,29 @@ def train_model_for_spectrogram_type(spectrogram_type, instrument_families):
 
     for family in instrument_families:
         print(f"Training model for {family}")
-        x_positive = load_data(family, spectrogram_type)[:150]
-        y_positive = np.ones(x_positive.shape[0])
-
-        x_negative = []
-        for other_family in instrument_families:
-            if other_family != family:
-                x_neg = load_data(other_family, spectrogram_type)[:150]
-                x_negative.append(x_neg)
-        x_negative = np.vstack(x_negative)
-        y_negative = np.zeros(x_negative.shape[0])
-
-        x_train = np.vstack((x_positive, x_negative))
-        y_train = np.concatenate((y_positive, y_negative))
-
-        # Expand dimensions to match the expected input shape for Conv2D
-        x_train = np.expand_dims(x_train, axis=-1)
-
-        model = create_model(input_shape=x_train[0].shape)
-
-        # Assuming `model` is already defined and compiled
-        # Adjust patience for early stopping and learning rate reduction
-        early_stopping = EarlyStopping(monitor='val_loss', patience=300, restore_best_weights=True)
-        reduce_lr = ReduceLROnPlateau(monitor='val_loss', patience=150, factor=0.5, min_lr=1e-7)
-
-        history = model.fit(x_train, y_train, validation_split=0.3, epochs=1000, callbacks=[early_stopping, reduce_lr])
-        model_save_path = os.path.join(models_dir, f'{spectrogram_type}_{family}.h5')
-        model.save(model_save_path)
+        with trace.stage('load_data', family=family):
+            x_positive = load_data(family, spectrogram_type)[:150]
+            y_positive = np.ones(x_positive.shape[0])
+
+            x_negative = []
+            for other_family in instrument_families:
+                if other_family != family:
+                    x_neg = load_data(other_family, spectrogram_type)[:150]
+                    x_negative.append(x_neg)
+            x_negative = np.vstack(x_negative)
+            y_negative = np.zeros(x_negative.shape[0])
+
+            x_train = np.vstack((x_positive, x_negative))
+            y_train = np.concatenate((y_positive, y_negative))
+
+            # Expand dimensions to match the expected input shape for Conv2D
+            x_train = np.expand_dims(x_train, axis=-1)
+
+        with trace.stage('model.fit', family=family):
+            model, history = fit_family_model(x_train, y_train)
+        with trace.stage('model.save', family=family):
+            model_save_path = os.path.join(models_dir, f'{spectrogram_type}_{family}.h5')
+            model.save(model_save_path)
 
         loss_file_path = os.path.join(metrics_dir, f'{spectrogram_type}_{family}_loss_curve.txt')
         acc_file_path = os.path.join(metrics_dir, f'{spectrogram_type}_{family}_acc_curve.txt')
@@ -131,11 +173,18 @@ def train_model_for_spectrogram_type(spectrogram_type, instrument_families):
             for loss, acc in zip(history.history['loss'], history.history['accuracy']):
                 f_loss.write(f"{loss}\n")
                 f_acc.write(f"{acc}\n")
+        save_training_metrics(spectrogram_type, family, history)
 
-        clear_gpu_memory(x_train, y_train)
+        with trace.stage('clear_gpu_memory', family=family):
+            clear_gpu_memory(x_train, y_train)
 
 # Train and save models for each spectrogram type
 for spectrogram_type in spectrogram_types:
-    train_model_for_spectrogram_type(spectrogram_type, instrument_families)
+    with trace.stage('train_model_for_spectrogram_type', spectrogram_type=spectrogram_type):
+        train_model_for_spectrogram_type(spectrogram_type, instrument_families)
 
 print("Training completed and models saved.")
+
+# Where the time went
+trace.summary()
+trace.close()
@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""inference-server
+
+Serve the 10 one-vs-all family models of one spectrogram type over HTTP (TCP or a Unix socket).
+
+ *   Loads the models saved by experiment_of_6_spectrograms.py once at start-up.
+ *   POST /predict accepts raw audio ({"audio": [...]}, 16 kHz NSynth clips) or a precomputed
+     spectrogram of the model input shape ({"features": [[...]]}) and returns the probability of every
+     family. Anything else (wrong shape, empty or multi-channel audio) is rejected with 400.
+ *   Feature extraction runs in a worker pool, using the same audio_to_* functions as prepare_samples.py.
+ *   Concurrent requests are collected into micro-batches: a batch is sent to the models when it is
+     full or when the oldest request has waited --max-latency-ms, whichever comes first.
+ *   GET /metrics returns p50/p90/p99 latency and the batch-size histogram, GET /health returns "ok".
+
+Example:
+    python inference_server.py --spectrogram-type log_mel --port 8080
+    curl -X POST localhost:8080/predict -d '{"audio": [0.0, 0.1, ...]}'
+"""
+
+import argparse
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+from script_functions import load_script_functions
+
+"""define the global vars"""
+
+# Directory paths
+output_dir = '/content/drive/My Drive/output-multi-gram/'
+models_dir = os.path.join(output_dir, 'models')
+
+# Instrument families, in the column order of the returned probabilities
+instrument_families = ['bass', 'brass', 'flute', 'guitar', 'keyboard', 'mallet', 'organ', 'reed', 'string', 'vocal']
+
+target_height = 300  # same target height prepare_samples.py resized the non-STFT spectrograms to
+
+feature_functions = load_script_functions('prepare_samples.py', [
+    'audio_to_spectrogram', 'audio_to_log_mel_spectrogram', 'audio_to_mfcc', 'audio_to_chroma',
+    'audio_to_spectral_contrast', 'audio_to_tonnetz', 'normalize_data', 'resize_spectrogram',
+    'concatenate_spectrograms_with_padding',
+])
+normalize_data = feature_functions['normalize_data']
+resize_spectrogram = feature_functions['resize_spectrogram']
+concatenate_spectrograms_with_padding = feature_functions['concatenate_spectrograms_with_padding']
+
+spectrogram_functions = {
+    'stft': feature_functions['audio_to_spectrogram'],
+    'log_mel': feature_functions['audio_to_log_mel_spectrogram'],
+    'mfcc': feature_functions['audio_to_mfcc'],
+    'chroma': feature_functions['audio_to_chroma'],
+    'spectral_contrast': feature_functions['audio_to_spectral_contrast'],
+    'tonnetz': feature_functions['audio_to_tonnetz']
+}
+
+"""features"""
+
+# Function to convert one audio clip the same way prepare_samples.py built the training data
+def extract_features(spectrogram_type, audio, sr=16000):
+    audio = np.asarray(audio, dtype=np.float32)
+    if spectrogram_type == 'all_combined_with_padding':
+        spectrograms = [extract_features(name, audio, sr) for name in spectrogram_functions]
+        return np.nan_to_num(concatenate_spectrograms_with_padding(spectrograms))
+
+    spec = spectrogram_functions[spectrogram_type](audio, sr=sr)
+    if spectrogram_type not in ['stft']:
+        spec = resize_spectrogram(spec, target_height)
+    return normalize_data(spec)
+
+# Function to bring a spectrogram to the (height, width) the models were trained on
+def fit_to_input_shape(spectrogram, input_shape):
+    height, width = input_shape
+    if spectrogram.shape != (height, width):
+        spectrogram = cv2.resize(spectrogram, (width, height), interpolation=cv2.INTER_CUBIC)
+    return spectrogram.astype(np.float32)
+
+"""models"""
+
+# Load models function
+def load_models(spectrogram_type):
+    from tensorflow.keras.models import load_model
+
+    model_cache = {}
+    for family in instrument_families:
+        model_path = os.path.join(models_dir, spectrogram_type, f'{spectrogram_type}_{family}.h5')
+        model_cache[family] = load_model(model_path)
+    return model_cache
+
+# Run every family model on one (B, H, W, 1) batch and return (B, 10) probabilities
+def predict_families(model_cache, x_batch):
+    y_pred = np.zeros((x_batch.shape[0], len(instrument_families)), dtype=np.float32)
+    for label, family in enumerate(instrument_families):
+        y_pred[:, label] = np.asarray(model_cache[family].predict_on_batch(x_batch)).flatten()
+    return y_pred
+
+"""metrics"""
+
+class ServerMetrics:
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies_ms = deque(maxlen=window)
+        self.batch_sizes = Counter()
+        self.requests = 0
+        self.errors = 0
+
+    def record_request(self, latency_ms, ok=True):
+        with self.lock:
+            self.requests += 1
+            self.errors += 0 if ok else 1
+            self.latencies_ms.append(latency_ms)
+
+    def record_batch(self, batch_size):
+        with self.lock:
+            self.batch_sizes[batch_size] += 1
+
+    def snapshot(self):
+        with self.lock:
+            latencies = np.array(self.latencies_ms)
+            batch_sizes = dict(sorted(self.batch_sizes.items()))
+            requests, errors = self.requests, self.errors
+        latency = {}
+        if len(latencies):
+            latency = {f'p{q}': float(np.percentile(latencies, q)) for q in (50, 90, 99)}
+            latency['mean'] = float(latencies.mean())
+        return {
+            'requests': requests,
+            'errors': errors,
+            'latency_ms': latency,
+            'batch_size_histogram': {str(size): count for size, count in batch_sizes.items()},
+            'batches': sum(batch_sizes.values()),
+        }
+
+"""micro-batching"""
+
+class MicroBatcher:
+    def __init__(self, predict_fn, metrics, max_batch_size=32, max_latency_ms=10.0, inference_workers=1):
+        self.predict_fn = predict_fn
+        self.metrics = metrics
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self.requests = queue.Queue()
+        # Batches are handed to the inference pool so the next one can be collected meanwhile.
+        # A batch only leaves once a worker is free; until then it keeps growing (backpressure)
+        self.inference_pool = ThreadPoolExecutor(max_workers=inference_workers)
+        self.free_workers = threading.Semaphore(inference_workers)
+        self.thread = threading.Thread(target=self.collect_batches, daemon=True)
+        self.thread.start()
+
+    def submit(self, features):
+        future = Future()
+        self.requests.put((time.monotonic(), features, future))
+        return future
+
+    def collect_batches(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+            batch = [item]
+            # The deadline is set by the oldest request in the batch
+            deadline = item[0] + self.max_latency
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.requests.put(None)
+                    break
+                batch.append(item)
+            self.wait_for_free_worker(batch)
+            self.inference_pool.submit(self.run_batch, batch)
+
+    def wait_for_free_worker(self, batch):
+        # While every inference worker is busy, block on the semaphore and add whatever requests
+        # arrived in the meantime to the batch
+        while len(batch) < self.max_batch_size:
+            if self.free_workers.acquire(timeout=self.max_latency):
+                return
+            while len(batch) < self.max_batch_size:
+                try:
+                    item = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.requests.put(None)
+                    self.free_workers.acquire()
+                    return
+                batch.append(item)
+        self.free_workers.acquire()
+
+    def padded_size(self, batch_size):
+        # Round up to a power of two (capped at max_batch_size): a lone request does not pay for a
+        # full batch, and the models only ever see about log2(max_batch_size) input shapes
+        return min(1 << (batch_size - 1).bit_length(), self.max_batch_size)
+
+    def run_batch(self, batch):
+        futures = [future for _, _, future in batch]
+        try:
+            x_batch = np.zeros((self.padded_size(len(batch)),) + batch[0][1].shape + (1,), dtype=np.float32)
+            x_batch[:len(batch), ..., 0] = np.stack([features for _, features, _ in batch])
+            y_pred = self.predict_fn(x_batch)[:len(batch)]
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        finally:
+            self.free_workers.release()
+        self.metrics.record_batch(len(batch))
+        for future, probabilities in zip(futures, y_pred):
+            future.set_result(probabilities)
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+        self.inference_pool.shutdown(wait=True)
+
+"""server"""
+
+class InferenceService:
+    def __init__(self, spectrogram_type, model_cache, max_batch_size=32, max_latency_ms=10.0,
+                 extract_workers=4, extract_processes=False, inference_workers=1):
+        self.spectrogram_type = spectrogram_type
+        self.model_cache = model_cache
+        self.input_shape = tuple(next(iter(model_cache.values())).input_shape[1:3])
+        self.metrics = ServerMetrics()
+        pool_class = ProcessPoolExecutor if extract_processes else ThreadPoolExecutor
+        self.extract_pool = pool_class(max_workers=extract_workers)
+        self.batcher = MicroBatcher(lambda x_batch: predict_families(self.model_cache, x_batch), self.metrics,
+                                    max_batch_size, max_latency_ms, inference_workers)
+
+    def predict(self, payload):
+        if 'features' in payload:
+            features = np.asarray(payload['features'], dtype=np.float32)
+            if features.shape != self.input_shape:
+                raise ValueError(f"expected a spectrogram of shape {self.input_shape}, got {features.shape}")
+        elif 'audio' in payload:
+            audio = np.asarray(payload['audio'], dtype=np.float32)
+            if audio.ndim != 1 or audio.size == 0:
+                raise ValueError(f"expected a non-empty 1-D audio array, got shape {audio.shape}")
+            features = self.extract_pool.submit(extract_features, self.spectrogram_type,
+                                                audio, payload.get('sr', 16000)).result()
+            # Clips that are not exactly 4 s give a different number of frames
+            features = fit_to_input_shape(features, self.input_shape)
+        else:
+            raise ValueError("request needs either 'audio' or 'features'")
+
+        probabilities = self.batcher.submit(features).result()
+        return {
+            'spectrogram_type': self.spectrogram_type,
+            'probabilities': {family: float(p) for family, p in zip(instrument_families, probabilities)},
+            'predicted': instrument_families[int(np.argmax(probabilities))],
+        }
+
+    def close(self):
+        self.batcher.close()
+        self.extract_pool.shutdown(wait=True)
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.send_json(200, self.service.metrics.snapshot())
+        elif self.path == '/health':
+            self.send_json(200, {'status': 'ok', 'spectrogram_type': self.service.spectrogram_type})
+        else:
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+            return
+        start = time.monotonic()
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            result = self.service.predict(json.loads(self.rfile.read(length)))
+        except (ValueError, KeyError) as e:
+            self.service.metrics.record_request((time.monotonic() - start) * 1000, ok=False)
+            self.send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self.service.metrics.record_request((time.monotonic() - start) * 1000, ok=False)
+            self.send_json(500, {'error': str(e)})
+            return
+        latency_ms = (time.monotonic() - start) * 1000
+        self.service.metrics.record_request(latency_ms)
+        result['latency_ms'] = latency_ms
+        self.send_json(200, result)
+
+    def address_string(self):
+        # Unix socket clients have no (host, port) address
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def make_server(service, host='127.0.0.1', port=8080, unix_socket=None):
+    handler = type('BoundInferenceRequestHandler', (InferenceRequestHandler,), {'service': service})
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        return ThreadingUnixHTTPServer(unix_socket, handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Serve the OvA instrument family models with micro-batching.')
+    parser.add_argument('--spectrogram-type', default='log_mel',
+                        choices=list(spectrogram_functions) + ['all_combined_with_padding'])
+    parser.add_argument('--models-dir', default=models_dir)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix-socket', default=None, help='listen on this Unix socket path instead of TCP')
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-latency-ms', type=float, default=10.0)
+    parser.add_argument('--extract-workers', type=int, default=4)
+    parser.add_argument('--extract-processes', action='store_true', help='extract features in processes instead of threads')
+    parser.add_argument('--inference-workers', type=int, default=1)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    models_dir = args.models_dir
+
+    print(f"Loading models for spectrogram type: {args.spectrogram_type}")
+    model_cache = load_models(args.spectrogram_type)
+    service = InferenceService(args.spectrogram_type, model_cache, args.max_batch_size, args.max_latency_ms,
+                               args.extract_workers, args.extract_processes, args.inference_workers)
+    server = make_server(service, args.host, args.port, args.unix_socket)
+    print(f"Serving {args.spectrogram_type} models on {args.unix_socket or f'{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""Per-stage timing, memory sampling and optional profiling for the prepare -> train -> test scripts.
+
+Wrap a stage with `with trace.stage('model.fit', family=family):` or decorate a function with
+`@trace.timed('load_models')`. Every finished stage is appended as one JSON line to
+`<trace_dir>/<run_name>_<run_id>.jsonl` with its duration and RSS (start, end, peak), and
+`trace.summary()` prints a table of where the time went.
+
+Set `profile='cprofile'` to dump a .prof file per profiled stage, or `profile='tf'` to capture
+a TensorBoard trace with tf.profiler. `profile_stages` limits profiling to those stage names.
+"""
+
+import cProfile
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+def current_rss_mb():
+    # /proc gives the current RSS on Linux (Colab); elsewhere fall back to the peak so far
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+class MemorySampler:
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.peaks = {}
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        rss = current_rss_mb()
+        with self.lock:
+            for key in self.peaks:
+                self.peaks[key] = max(self.peaks[key], rss)
+        return rss
+
+    # Track the peak RSS seen between start_window() and end_window() for one stage
+    def start_window(self, key):
+        rss = current_rss_mb()
+        with self.lock:
+            self.peaks[key] = rss
+        return rss
+
+    def end_window(self, key):
+        rss = self.sample()
+        with self.lock:
+            return rss, self.peaks.pop(key, rss)
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+class RunTrace:
+    def __init__(self, run_name, trace_dir, profile=None, profile_stages=None, sample_memory=True, sample_interval=0.5):
+        if profile not in (None, 'cprofile', 'tf'):
+            raise ValueError(f"profile must be None, 'cprofile' or 'tf', got {profile!r}")
+        self.run_name = run_name
+        self.run_id = time.strftime('%Y%m%d-%H%M%S') + '-' + uuid.uuid4().hex[:6]
+        self.trace_dir = trace_dir
+        self.profile = profile
+        self.profile_stages = set(profile_stages) if profile_stages else None
+        self.profiling = False
+        self.profile_count = 0
+        self.stack = []
+        self.totals = OrderedDict()
+        self.lock = threading.Lock()
+        self.run_start = time.perf_counter()
+        self.sampler = MemorySampler(sample_interval) if sample_memory else None
+
+        os.makedirs(trace_dir, exist_ok=True)
+        self.trace_path = os.path.join(trace_dir, f'{run_name}_{self.run_id}.jsonl')
+        self.write_event({'event': 'run_start', 'profile': profile, 'pid': os.getpid(), 'rss_mb': current_rss_mb()})
+
+    def write_event(self, event):
+        event = {'run': self.run_name, 'run_id': self.run_id, 'time': time.time(), **event}
+        with self.lock, open(self.trace_path, 'a') as f:
+            f.write(json.dumps(event, default=str) + '\n')
+
+    def should_profile(self, name):
+        # cProfile and tf.profiler cannot nest, so only the outermost matching stage is profiled
+        if self.profile is None or self.profiling:
+            return False
+        return name in self.profile_stages if self.profile_stages is not None else not self.stack
+
+    @contextmanager
+    def capture_profile(self, path):
+        self.profiling = True
+        profile_file = os.path.join(self.trace_dir, f"{self.run_name}_{self.run_id}_{path.replace('/', '.')}")
+        if self.profile == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                self.profile_count += 1
+                profiler.dump_stats(profile_file + f'_{self.profile_count}.prof')
+                self.profiling = False
+        else:
+            import tensorflow as tf
+            tf.profiler.experimental.start(profile_file)
+            try:
+                yield
+            finally:
+                tf.profiler.experimental.stop()
+                self.profiling = False
+
+    @contextmanager
+    def stage(self, name, **attrs):
+        path = '/'.join(self.stack + [name])
+        with self.lock:
+            # Register on entry so the summary lists parents before their children
+            self.totals.setdefault(path, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'peak_rss_mb': 0.0,
+                                          'depth': len(self.stack)})
+        self.stack.append(name)
+        key = (path, len(self.stack), time.perf_counter())
+        rss_start = self.sampler.start_window(key) if self.sampler else current_rss_mb()
+        start_wall = time.time()
+        start = time.perf_counter()
+        error = None
+        try:
+            if self.should_profile(name):
+                with self.capture_profile(path):
+                    yield
+            else:
+                yield
+        except BaseException as e:
+            error = repr(e)
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            rss_end, rss_peak = self.sampler.end_window(key) if self.sampler else (current_rss_mb(),) * 2
+            self.stack.pop()
+            self.record(path, name, len(self.stack), start_wall, duration, rss_start, rss_end, rss_peak, error, attrs)
+
+    def record(self, path, name, depth, start_wall, duration, rss_start, rss_end, rss_peak, error, attrs):
+        with self.lock:
+            total = self.totals[path]
+            total['count'] += 1
+            total['seconds'] += duration
+            total['max_seconds'] = max(total['max_seconds'], duration)
+            total['peak_rss_mb'] = max(total['peak_rss_mb'], rss_peak)
+        event = {'event': 'stage', 'stage': path, 'name': name, 'depth': depth, 'start': start_wall,
+                 'duration_s': duration, 'rss_start_mb': rss_start, 'rss_end_mb': rss_end, 'rss_peak_mb': rss_peak}
+        if error:
+            event['error'] = error
+        if attrs:
+            event['attrs'] = attrs
+        self.write_event(event)
+
+    def timed(self, name=None):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name or func.__name__):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self):
+        run_seconds = time.perf_counter() - self.run_start
+        print(f"\nStage timings for {self.run_name} ({self.run_id}), total {run_seconds:.1f}s")
+        print(f"{'stage':<60}{'count':>7}{'total s':>11}{'mean s':>10}{'max s':>10}{'% run':>8}{'peak MB':>10}")
+        for path, total in self.totals.items():
+            label = '  ' * total['depth'] + path.split('/')[-1]
+            print(f"{label:<60}{total['count']:>7}{total['seconds']:>11.2f}{total['seconds'] / max(total['count'], 1):>10.2f}"
+                  f"{total['max_seconds']:>10.2f}{100 * total['seconds'] / run_seconds:>8.1f}{total['peak_rss_mb']:>10.0f}")
+        print(f"Trace saved to {self.trace_path}")
+        return self.totals
+
+    def close(self):
+        if self.sampler:
+            self.sampler.stop()
+        self.write_event({'event': 'run_end', 'duration_s': time.perf_counter() - self.run_start,
+                          'rss_mb': current_rss_mb(), 'stages': self.totals})
@@ -8,6 +8,7 @@ from google.colab import drive
 import librosa
 import tensorflow_datasets as tfds
 import cv2
+from pipeline_profiler import RunTrace
 
 """mount disk"""
 
@@ -18,6 +19,10 @@ drive.mount('/content/drive')
 save_dir = '/content/drive/My Drive/200-each-instrument/'
 os.makedirs(save_dir, exist_ok=True)
 
+# Per-stage timing trace (JSONL in save_dir/traces); set profile_mode to 'cprofile' or 'tf' to also capture profiles
+profile_mode = None
+trace = RunTrace('prepare_samples', trace_dir=os.path.join(save_dir, 'traces'), profile=profile_mode)
+
 # Instrument family mapping
 label_map_10 = {
     0: 'bass',
@@ -40,7 +45,8 @@ data_dict = {label: [] for label in label_map_10.values()}
 """download 70GiB dataset"""
 
 # Load NSynth dataset
-ds = tfds.load('nsynth', split='train+test+valid')
+with trace.stage('load_nsynth'):
+    ds = tfds.load('nsynth', split='train+test+valid')
 
 """store samples"""
 
@@ -48,25 +54,27 @@ ds = tfds.load('nsynth', split='train+test+valid')
 data_dict = {label: [] for label in label_map_10.values()}
 
 # Iterate through the dataset and separate data by instrument family
-sample_limit = 200
-for example in ds:
-    family_label = example['instrument']['family'].numpy()
-    if family_label in label_map_10:
-        instrument_family = label_map_10[family_label]
-        if len(data_dict[instrument_family]) < sample_limit:
-            audio = example['audio'].numpy()
-            data_dict[instrument_family].append(audio)
-
-    # Stop if we have enough samples for each family
-    if all(len(data) >= sample_limit for data in data_dict.values()):
-        break
+with trace.stage('collect_samples'):
+    sample_limit = 200
+    for example in ds:
+        family_label = example['instrument']['family'].numpy()
+        if family_label in label_map_10:
+            instrument_family = label_map_10[family_label]
+            if len(data_dict[instrument_family]) < sample_limit:
+                audio = example['audio'].numpy()
+                data_dict[instrument_family].append(audio)
+
+        # Stop if we have enough samples for each family
+        if all(len(data) >= sample_limit for data in data_dict.values()):
+            break
 
 # Ensure each family has 200 samples by repeating samples if necessary
-for family, data in data_dict.items():
-    if len(data) < 200:
-        data = data * (200 // len(data)) + data[:200 % len(data)]
-    data_dict[family] = np.array(data[:200])
-    # np.save(os.path.join(save_dir, f'{family}.npy'), data_dict[family])
+with trace.stage('balance_samples'):
+    for family, data in data_dict.items():
+        if len(data) < 200:
+            data = data * (200 // len(data)) + data[:200 % len(data)]
+        data_dict[family] = np.array(data[:200])
+        # np.save(os.path.join(save_dir, f'{family}.npy'), data_dict[family])
 
 print(f"Data for each instrument family has been saved to {save_dir}")
 
@@ -137,23 +145,26 @@ spectrogram_functions = {
 }
 
 for spectrogram_type, spectrogram_function in spectrogram_functions.items():
-    spectrogram_save_dir = os.path.join(save_dir, spectrogram_type)
-    os.makedirs(spectrogram_save_dir, exist_ok=True)
-
-    for family in data_dict.keys():
-        family_save_dir = os.path.join(spectrogram_save_dir, family)
-        os.makedirs(family_save_dir, exist_ok=True)
-
-        audio_samples = np.load(os.path.join(save_dir, f'{family}.npy'))
-        spectrograms = []
-        for audio in audio_samples:
-            spec = spectrogram_function(audio)
-            if spectrogram_type not in ['stft']:
-                spec = resize_spectrogram(spec, target_height)
-            normalized_spec = normalize_spectrogram(spec)
-            spectrograms.append(normalized_spec)
-        spectrograms = np.array(spectrograms)
-        # np.save(os.path.join(family_save_dir, f'{family}_{spectrogram_type}.npy'), spectrograms)
+    with trace.stage('extract_features', spectrogram_type=spectrogram_type):
+        spectrogram_save_dir = os.path.join(save_dir, spectrogram_type)
+        os.makedirs(spectrogram_save_dir, exist_ok=True)
+
+        for family in data_dict.keys():
+            family_save_dir = os.path.join(spectrogram_save_dir, family)
+            os.makedirs(family_save_dir, exist_ok=True)
+
+            with trace.stage('np_load', family=family):
+                audio_samples = np.load(os.path.join(save_dir, f'{family}.npy'))
+            with trace.stage('spectrogram_function', family=family):
+                spectrograms = []
+                for audio in audio_samples:
+                    spec = spectrogram_function(audio)
+                    if spectrogram_type not in ['stft']:
+                        spec = resize_spectrogram(spec, target_height)
+                    normalized_spec = normalize_spectrogram(spec)
+                    spectrograms.append(normalized_spec)
+                spectrograms = np.array(spectrograms)
+            # np.save(os.path.join(family_save_dir, f'{family}_{spectrogram_type}.npy'), spectrograms)
 
 print(f"Spectrograms for each instrument family have been saved to {save_dir}")
 
@@ -198,26 +209,30 @@ def concatenate_spectrograms_with_padding(spectrograms, padding_size=5):
     return np.concatenate(resized_spectrograms, axis=0)
 
 # Combine spectrograms and save
-for family in instrument_families:
-    all_spectrograms = []
-    for spectrogram_type in spectrogram_types:
-        spectrograms = load_data(family, spectrogram_type)
-        all_spectrograms.append(spectrograms)
+with trace.stage('combine_spectrograms'):
+    for family in instrument_families:
+        with trace.stage('np_load', family=family):
+            all_spectrograms = []
+            for spectrogram_type in spectrogram_types:
+                spectrograms = load_data(family, spectrogram_type)
+                all_spectrograms.append(spectrograms)
 
-    combined_spectrograms = np.array([
-        concatenate_spectrograms_with_padding([all_spectrograms[j][i] for j in range(len(spectrogram_types))])
-        for i in range(all_spectrograms[0].shape[0])
-    ])
+        with trace.stage('concatenate_spectrograms_with_padding', family=family):
+            combined_spectrograms = np.array([
+                concatenate_spectrograms_with_padding([all_spectrograms[j][i] for j in range(len(spectrogram_types))])
+                for i in range(all_spectrograms[0].shape[0])
+            ])
 
-    # Check for NaNs or infinite values in combined spectrograms
-    check_nan_inf(combined_spectrograms)
+        # Check for NaNs or infinite values in combined spectrograms
+        check_nan_inf(combined_spectrograms)
 
-    # Further handle any remaining NaNs or infinite values
-    combined_spectrograms = np.nan_to_num(combined_spectrograms)
+        # Further handle any remaining NaNs or infinite values
+        combined_spectrograms = np.nan_to_num(combined_spectrograms)
 
-    # Save the combined spectrograms
-    save_path = os.path.join(combined_save_dir, f'{family}_combined.npy')
-    np.save(save_path, combined_spectrograms)
+        # Save the combined spectrograms
+        with trace.stage('np_save', family=family):
+            save_path = os.path.join(combined_save_dir, f'{family}_combined.npy')
+            np.save(save_path, combined_spectrograms)
 
 print(f"Combined spectrograms for each instrument have been saved to {combined_save_dir}")
 
@@ -230,13 +245,17 @@ def plot_combined_spectrograms(spectrogram, title):
     plt.show()
 
 # Load and plot a few samples from the combined spectrograms for visualization
-for instrument_family in instrument_families:
-    combined_spectrograms = np.load(os.path.join(combined_save_dir, f'{instrument_family}_combined.npy'))
+with trace.stage('load_combined'):
+    for instrument_family in instrument_families:
+        combined_spectrograms = np.load(os.path.join(combined_save_dir, f'{instrument_family}_combined.npy'))
     # for i in range(5):
      #    plot_combined_spectrograms(combined_spectrograms[i], f'Combined Spectrograms for {instrument_family} - Sample {i+1}')
 
 """plot"""
 
+from concurrent.futures import ProcessPoolExecutor
+from scipy.ndimage import convolve
+
 # Directory paths
 base_dir = '/content/drive/My Drive/200-each-instrument/'
 combined_save_dir = os.path.join(base_dir, 'all_combined_with_padding')
@@ -245,6 +264,9 @@ os.makedirs(plot_save_dir, exist_ok=True)
 spectrogram_types = ['stft', 'log_mel', 'mfcc', 'chroma', 'spectral_contrast', 'tonnetz']
 instrument_families = ['bass', 'brass', 'flute', 'guitar', 'keyboard', 'mallet', 'organ', 'reed', 'string', 'vocal']
 
+# Figures are rendered in worker processes with the Agg backend
+n_plot_workers = os.cpu_count()
+
 # Function to load data
 def load_data(family, spectrogram_type=None):
     if spectrogram_type:
@@ -253,12 +275,21 @@ def load_data(family, spectrogram_type=None):
         file_path = os.path.join(base_dir, f'{family}.npy')
     return np.load(file_path)
 
+# Function to load the first sample of every family from one source, stacked to (families, ...).
+# mmap_mode only reads that sample from Drive instead of the whole array
+def load_first_samples(file_paths):
+    return np.stack([np.array(np.load(file_path, mmap_mode='r')[0]) for file_path in file_paths])
+
+# Function to apply a simple 2D convolution and ReLU activation to a stack of (N, H, W) spectrograms at once.
+# The kernel is 1 along the first axis, so every spectrogram is convolved on its own
+def apply_simple_conv2d_and_relu_batch(spectrograms, scale=0.01):
+    kernel = np.full((1, 3, 3), scale)
+    conv = convolve(spectrograms, kernel)
+    return np.maximum(0, conv)
+
 # Function to apply a simple 2D convolution and ReLU activation
 def apply_simple_conv2d_and_relu(spectrogram, scale=0.01):
-    from scipy.ndimage import convolve
-    kernel = np.array([[scale, scale, scale], [scale, scale, scale], [scale, scale, scale]])
-    conv = convolve(spectrogram, kernel)
-    relu = np.maximum(0, conv)
+    relu = apply_simple_conv2d_and_relu_batch(spectrogram[np.newaxis], scale)[0]
     return relu[..., np.newaxis]
 
 # Function to plot combined spectrograms without any additional elements
@@ -274,79 +305,109 @@ def plot_combined_spectrograms(audio_sample, sr=16000):
 
     return combined_feature
 
+# Function to load every source once and compute the Conv2D + ReLU previews for all families together
+def prepare_instrument_panels():
+    with trace.stage('load_plot_sources'):
+        raw_audio = load_first_samples([os.path.join(base_dir, f'{family}.npy') for family in instrument_families])
+        combined = load_first_samples([os.path.join(combined_save_dir, f'{family}_combined.npy') for family in instrument_families])
+        spectrograms = {spectrogram_type: load_first_samples([os.path.join(base_dir, spectrogram_type, family, f'{family}_{spectrogram_type}.npy')
+                                                              for family in instrument_families])
+                        for spectrogram_type in spectrogram_types}
+
+    # Apply simple Conv2D and ReLU twice with smaller kernel values (0.05 for the combined spectrogram)
+    with trace.stage('conv_previews'):
+        previews = {}
+        for name, stack, scale in [('combined', combined, 0.05)] + [(t, s, 0.01) for t, s in spectrograms.items()]:
+            conv1 = apply_simple_conv2d_and_relu_batch(stack, scale=scale)
+            previews[name] = (conv1, apply_simple_conv2d_and_relu_batch(conv1, scale=scale))
+
+    panels = {}
+    for i, family in enumerate(instrument_families):
+        panels[family] = {
+            'raw_audio': raw_audio[i],
+            'combined': (combined[i],) + tuple(conv[i] for conv in previews['combined']),
+            'spectrograms': {spectrogram_type: (spectrograms[spectrogram_type][i],) + tuple(conv[i] for conv in previews[spectrogram_type])
+                             for spectrogram_type in spectrogram_types},
+        }
+    return panels
+
+def use_agg_backend():
+    plt.switch_backend('Agg')
+
+# Function to draw and save the 4 x 6 figure of one family (runs in a worker process)
+def render_instrument_plot(family, panels, plot_path):
+    fig, axs = plt.subplots(4, 6, figsize=(30, 20))
+    fig.suptitle(f'{family.capitalize()} - First Sample', fontsize=16)
+
+    # Plot raw audio
+    axs[3, 0].plot(panels['raw_audio'])
+    axs[3, 0].set_title('Raw Audio')
+    axs[3, 0].axis('off')
+
+    # Leave two empty subplots after raw audio
+    axs[3, 1].axis('off')
+    axs[3, 2].axis('off')
+
+    # Combined spectrogram and its Conv2D + ReLU previews
+    combined_spec, combined_conv1_spec, combined_conv2_spec = panels['combined']
+    axs[3, 3].imshow(combined_spec, aspect='auto', origin='lower', cmap='viridis')
+    axs[3, 3].set_title('All Combined Spectrogram')
+    axs[3, 3].axis('off')
+
+    axs[3, 4].imshow(combined_conv1_spec, aspect='auto', origin='lower', cmap='viridis')
+    axs[3, 4].set_title('All Combined Conv2D + ReLU (1st)')
+    axs[3, 4].axis('off')
+
+    axs[3, 5].imshow(combined_conv2_spec, aspect='auto', origin='lower', cmap='viridis')
+    axs[3, 5].set_title('All Combined Conv2D + ReLU (2nd)')
+    axs[3, 5].axis('off')
+
+    # Plot each spectrogram type and its Conv2D + ReLU previews
+    for i, spectrogram_type in enumerate(spectrogram_types):
+        spectrogram, conv1_spec, conv2_spec = panels['spectrograms'][spectrogram_type]
+        row = i // 2
+        col = (i % 2) * 3
+        if spectrogram_type in ['stft', 'log_mel']:
+            librosa.display.specshow(spectrogram, sr=16000, ax=axs[row, col], x_axis='time', y_axis='log')
+        elif spectrogram_type == 'mfcc':
+            librosa.display.specshow(spectrogram, sr=16000, ax=axs[row, col], x_axis='time')
+        elif spectrogram_type == 'chroma':
+            librosa.display.specshow(spectrogram, sr=16000, ax=axs[row, col], y_axis='chroma', x_axis='time')
+        elif spectrogram_type == 'spectral_contrast':
+            librosa.display.specshow(spectrogram, sr=16000, ax=axs[row, col], x_axis='time')
+        elif spectrogram_type == 'tonnetz':
+            librosa.display.specshow(spectrogram, sr=16000, ax=axs[row, col], y_axis='tonnetz', x_axis='time')
+
+        axs[row, col].set_title(spectrogram_type.capitalize())
+
+        axs[row, col + 1].imshow(conv1_spec, aspect='auto', origin='lower', cmap='viridis')
+        axs[row, col + 1].set_title(f'{spectrogram_type.capitalize()} Conv2D + ReLU (1st)')
+        axs[row, col + 2].imshow(conv2_spec, aspect='auto', origin='lower', cmap='viridis')
+        axs[row, col + 2].set_title(f'{spectrogram_type.capitalize()} Conv2D + ReLU (2nd)')
+
+    fig.tight_layout(rect=[0, 0, 1, 0.97])
+    fig.savefig(plot_path)
+    plt.close(fig)
+    return plot_path
+
 # Plotting function
 def plot_instrument_samples():
-    for family in instrument_families:
-        # Create subdirectory for storing plots
-        family_plot_save_dir = os.path.join(plot_save_dir, family)
-        os.makedirs(family_plot_save_dir, exist_ok=True)
-
-        fig, axs = plt.subplots(4, 6, figsize=(30, 20))
-        fig.suptitle(f'{family.capitalize()} - First Sample', fontsize=16)
-
-        # Load and plot raw audio
-        raw_audio = np.load(os.path.join(base_dir, f'{family}.npy'))[0]
-        axs[3, 0].plot(raw_audio)
-        axs[3, 0].set_title('Raw Audio')
-        axs[3, 0].axis('off')
-
-        # Leave two empty subplots after raw audio
-        axs[3, 1].axis('off')
-        axs[3, 2].axis('off')
-
-        # Load combined spectrograms
-        combined_spectrograms = np.load(os.path.join(combined_save_dir, f'{family}_combined.npy'))
-        im = axs[3, 3].imshow(combined_spectrograms[0], aspect='auto', origin='lower', cmap='viridis')
-        axs[3, 3].set_title('All Combined Spectrogram')
-        axs[3, 3].axis('off')
-
-        # Apply simple Conv2D and ReLU twice with smaller kernel values to combined spectrogram
-        combined_conv1_spec = apply_simple_conv2d_and_relu(combined_spectrograms[0], scale=0.05)
-        combined_conv2_spec = apply_simple_conv2d_and_relu(combined_conv1_spec[:, :, 0], scale=0.05)  # Apply on the first channel
-
-        axs[3, 4].imshow(combined_conv1_spec[:, :, 0], aspect='auto', origin='lower', cmap='viridis')
-        axs[3, 4].set_title('All Combined Conv2D + ReLU (1st)')
-        axs[3, 4].axis('off')
-
-        axs[3, 5].imshow(combined_conv2_spec[:, :, 0], aspect='auto', origin='lower', cmap='viridis')
-        axs[3, 5].set_title('All Combined Conv2D + ReLU (2nd)')
-        axs[3, 5].axis('off')
-
-        # Load, plot, and apply Conv2D and ReLU for each spectrogram type
-        for i, spectrogram_type in enumerate(spectrogram_types):
-            spectrogram = load_data(family, spectrogram_type)[0]
-            row = i // 2
-            col = (i % 2) * 3
-            if spectrogram_type in ['stft', 'log_mel']:
-                librosa.display.specshow(spectrogram, sr=16000, ax=axs[row, col], x_axis='time', y_axis='log')
-            elif spectrogram_type == 'mfcc':
-                librosa.display.specshow(spectrogram, sr=16000, ax=axs[row, col], x_axis='time')
-            elif spectrogram_type == 'chroma':
-                librosa.display.specshow(spectrogram, sr=16000, ax=axs[row, col], y_axis='chroma', x_axis='time')
-            elif spectrogram_type == 'spectral_contrast':
-                librosa.display.specshow(spectrogram, sr=16000, ax=axs[row, col], x_axis='time')
-            elif spectrogram_type == 'tonnetz':
-                librosa.display.specshow(spectrogram, sr=16000, ax=axs[row, col], y_axis='tonnetz', x_axis='time')
-
-            axs[row, col].set_title(spectrogram_type.capitalize())
-
-            # Apply simple Conv2D and ReLU twice with smaller kernel values
-            conv1_spec = apply_simple_conv2d_and_relu(spectrogram, scale=0.01)
-            conv2_spec = apply_simple_conv2d_and_relu(conv1_spec[:, :, 0], scale=0.01)  # Apply on the first channel
-
-            axs[row, col + 1].imshow(conv1_spec[:, :, 0], aspect='auto', origin='lower', cmap='viridis')
-            axs[row, col + 1].set_title(f'{spectrogram_type.capitalize()} Conv2D + ReLU (1st)')
-            axs[row, col + 2].imshow(conv2_spec[:, :, 0], aspect='auto', origin='lower', cmap='viridis')
-            axs[row, col + 2].set_title(f'{spectrogram_type.capitalize()} Conv2D + ReLU (2nd)')
-
-        plt.tight_layout(rect=[0, 0, 1, 0.97])
-
-        plot_path = os.path.join(family_plot_save_dir, f'{family}_plot.png')
-        plt.savefig(plot_path)
-        plt.close()
+    panels = prepare_instrument_panels()
+
+    with trace.stage('render_plots'), ProcessPoolExecutor(max_workers=n_plot_workers, initializer=use_agg_backend) as pool:
+        futures = []
+        for family in instrument_families:
+            # Create subdirectory for storing plots
+            family_plot_save_dir = os.path.join(plot_save_dir, family)
+            os.makedirs(family_plot_save_dir, exist_ok=True)
+            plot_path = os.path.join(family_plot_save_dir, f'{family}_plot.png')
+            futures.append(pool.submit(render_instrument_plot, family, panels[family], plot_path))
+        for future in futures:
+            future.result()
 
 # plot
-plot_instrument_samples()
+with trace.stage('plot_instrument_samples'):
+    plot_instrument_samples()
 
 """polyphony"""
 
@@ -409,18 +470,21 @@ def generate_validation_data(samples_per_family, shape, num_samples_per_combinat
     return np.array(test_samples), np.array(true_labels)
 
 # Load samples per family
-samples_per_family = {i: load_combined_data(family)[:50] for i, family in enumerate(instrument_families)}
+with trace.stage('load_combined'):
+    samples_per_family = {i: load_combined_data(family)[:50] for i, family in enumerate(instrument_families)}
 
 # Determine the shape of the spectrograms
 example_spectrogram = samples_per_family[0][0]
 shape = example_spectrogram.shape
 
 # Generate validation data
-test_samples, true_labels = generate_validation_data(samples_per_family, shape)
+with trace.stage('generate_validation_data'):
+    test_samples, true_labels = generate_validation_data(samples_per_family, shape)
 
 # Save the generated data
-np.save(os.path.join(base_dir, 'validation_samples.npy'), test_samples)
-np.save(os.path.join(base_dir, 'validation_labels.npy'), true_labels)
+with trace.stage('np_save'):
+    np.save(os.path.join(base_dir, 'validation_samples.npy'), test_samples)
+    np.save(os.path.join(base_dir, 'validation_labels.npy'), true_labels)
 
 print("Validation data generation completed and saved.")
 
@@ -439,3 +503,7 @@ def plot_samples(test_samples, true_labels, num_samples=5):
 
 # Example usage:
 plot_samples(test_samples, true_labels, num_samples=5)
+
+# Where the time went
+trace.summary()
+trace.close()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""Load function definitions from the Colab scripts without running them.
+
+prepare_samples.py, experiment_of_6_spectrograms.py and testing_of_6_spectrograms.py
+mount Google Drive and start downloading/training as soon as they are imported.
+The tools in this folder (server, benchmarks, ...) only need a few of their functions,
+so they pull the `def` blocks (plus the imports those use) out of the source
+and execute just those. That way they always use the same code the experiment ran.
+"""
+
+import ast
+import os
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Imports that only work (or only make sense) inside Colab
+skipped_imports = ['google.colab', 'tensorflow_datasets']
+
+def is_skipped_import(node):
+    if isinstance(node, ast.ImportFrom):
+        names = [node.module or '']
+    else:
+        names = [alias.name for alias in node.names]
+    return any(name == skipped or name.startswith(skipped + '.') for name in names for skipped in skipped_imports)
+
+def used_dotted_names(functions):
+    # 'librosa.display.specshow' in a body yields 'librosa', 'librosa.display', 'librosa.display.specshow'
+    used = set()
+    for function in functions:
+        for node in ast.walk(function):
+            parts = []
+            while isinstance(node, ast.Attribute):
+                parts.insert(0, node.attr)
+                node = node.value
+            if isinstance(node, ast.Name):
+                parts.insert(0, node.id)
+                used.update('.'.join(parts[:i]) for i in range(1, len(parts) + 1))
+    return used
+
+def required_aliases(node, used):
+    # `import a.b` binds `a` but is only kept if `a.b` itself is used
+    return [alias for alias in node.names if (alias.asname or alias.name) in used]
+
+def load_script_functions(script_name, function_names):
+    script_path = os.path.join(script_dir, script_name)
+    with open(script_path, 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read(), filename=script_path)
+
+    functions = [node for node in tree.body if isinstance(node, ast.FunctionDef) and node.name in function_names]
+    used = used_dotted_names(functions)
+
+    # Keep the module-level imports those functions use and the functions themselves, in
+    # source order, so a function redefined later in the script resolves to its last definition
+    body = []
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            aliases = required_aliases(node, used)
+            if aliases and not is_skipped_import(node):
+                body.append(type(node)(**{**node.__dict__, 'names': aliases}))
+        elif node in functions:
+            body.append(node)
+
+    namespace = {'__name__': os.path.splitext(script_name)[0], '__file__': script_path}
+    exec(compile(ast.Module(body=body, type_ignores=[]), script_path, 'exec'), namespace)
+
+    missing = [name for name in function_names if name not in namespace]
+    if missing:
+        raise ValueError(f"{script_name} does not define: {', '.join(missing)}")
+    return {name: namespace[name] for name in function_names}
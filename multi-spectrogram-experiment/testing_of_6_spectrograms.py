@@ -18,6 +18,7 @@ from google.colab import drive
 from tensorflow.keras.models import load_model
 from sklearn.metrics import classification_report, confusion_matrix
 import cv2  # Import OpenCV for resizing
+from pipeline_profiler import RunTrace
 
 """Mount google drive"""
 
@@ -39,6 +40,10 @@ test_results_dir = os.path.join(output_dir, 'test_results')
 
 os.makedirs(test_results_dir, exist_ok=True)
 
+# Per-stage timing trace (JSONL in output_dir/traces); set profile_mode to 'cprofile' or 'tf' to also capture profiles
+profile_mode = None
+trace = RunTrace('testing_of_6_spectrograms', trace_dir=os.path.join(output_dir, 'traces'), profile=profile_mode)
+
 """load data
 
 """
@@ -109,7 +114,8 @@ def load_models(spectrogram_type):
     model_cache = {}
     for family in instrument_families:
         model_path = os.path.join(models_dir, spectrogram_type, f'{spectrogram_type}_{family}.h5')
-        model_cache[family] = load_model(model_path)
+        with trace.stage('load_model', family=family):
+            model_cache[family] = load_model(model_path)
     return model_cache
 
 # Function to resize spectrograms
@@ -118,35 +124,42 @@ def resize_spectrogram(spectrogram, target_shape):
 
 """validation"""
 
+# Function to run every family model on x_val; column `label` holds that family's probability
+def predict_family_probabilities(model_cache, x_val, family_labels):
+    y_pred = np.zeros((x_val.shape[0], len(family_labels)))
+    for family, label in family_labels.items():
+        y_pred[:, label] = model_cache[family].predict(x_val).flatten()
+    return y_pred
+
 # Validation function
 def validate_and_save_results(spectrogram_type, model_cache):
     x_val = []
     y_val = []
 
-    for family, label in instrument_families.items():
-        data_check = load_data(family, spectrogram_type)[:1] # check the first training sample size
-        data = load_data(family, spectrogram_type)[-50:]  # Get the last 50 samples
-        if data[0].shape != data_check[0].shape:
-            # 6(spetrogram)+1(all_combined) * 10(instrument) = 70(senario) so need to debug if there is a mistake while we generate the data
-            print(f"Resizing required for {spectrogram_type}, {family}, index: 0")
-            print(f"Training shape: {data_check[0].shape}, Testing shape: {data[0].shape}")
+    with trace.stage('load_data'):
+        for family, label in instrument_families.items():
+            data_check = load_data(family, spectrogram_type)[:1] # check the first training sample size
+            data = load_data(family, spectrogram_type)[-50:]  # Get the last 50 samples
+            if data[0].shape != data_check[0].shape:
+                # 6(spetrogram)+1(all_combined) * 10(instrument) = 70(senario) so need to debug if there is a mistake while we generate the data
+                print(f"Resizing required for {spectrogram_type}, {family}, index: 0")
+                print(f"Training shape: {data_check[0].shape}, Testing shape: {data[0].shape}")
 
-            target_shape = data_check[0].shape
-            resized_data = np.array([resize_spectrogram(s, target_shape) for s in data])
+                target_shape = data_check[0].shape
+                resized_data = np.array([resize_spectrogram(s, target_shape) for s in data])
 
-        else:
-            resized_data = data
-        x_val.append(resized_data)
-        y_val.extend([label] * len(resized_data))
+            else:
+                resized_data = data
+            x_val.append(resized_data)
+            y_val.extend([label] * len(resized_data))
 
     x_val = np.concatenate(x_val, axis=0)
     y_val = np.array(y_val)
 
     x_val = np.expand_dims(x_val, axis=-1)
 
-    y_pred = np.zeros((x_val.shape[0], len(instrument_families)))
-    for family, label in instrument_families.items():
-        y_pred[:, label] = model_cache[family].predict(x_val).flatten()
+    with trace.stage('predict'):
+        y_pred = predict_family_probabilities(model_cache, x_val, instrument_families)
 
     y_pred_labels = np.argmax(y_pred, axis=1)
 
@@ -167,8 +180,11 @@ def validate_and_save_results(spectrogram_type, model_cache):
 
 # Main validation loop for all spectrogram types
 for spectrogram_type in spectrogram_types:
-    model_cache = load_models(spectrogram_type)
-    validate_and_save_results(spectrogram_type, model_cache)
+    with trace.stage('validate_spectrogram_type', spectrogram_type=spectrogram_type):
+        with trace.stage('load_models'):
+            model_cache = load_models(spectrogram_type)
+        with trace.stage('validate_and_save_results'):
+            validate_and_save_results(spectrogram_type, model_cache)
 
 print("Validation completed and results saved.")
 
@@ -177,12 +193,15 @@ print("Validation completed and results saved.")
 import matplotlib.pyplot as plt
 import numpy as np
 import os
+import json
+from concurrent.futures import ProcessPoolExecutor
 from matplotlib.gridspec import GridSpec
 
 # Directory paths
 base_dir = '/content/drive/My Drive/200-each-instrument/'
 output_dir = '/content/drive/My Drive/output-multi-gram/'
 metrics_dir = os.path.join(output_dir, 'metrics')
+training_metrics_path = os.path.join(metrics_dir, 'training_metrics.json')
 
 # Instrument families and their original NSynth labels
 instrument_families = ['bass', 'brass', 'flute', 'guitar', 'keyboard', 'mallet', 'organ', 'reed', 'string', 'vocal']
@@ -190,12 +209,46 @@ instrument_families = ['bass', 'brass', 'flute', 'guitar', 'keyboard', 'mallet',
 # Spectrogram types
 spectrogram_types = ['stft', 'log_mel', 'mfcc', 'chroma', 'spectral_contrast', 'tonnetz', 'all_combined_with_padding']
 
+# Figures are rendered in worker processes with the Agg backend; set show_plots to False to only save them
+n_plot_workers = os.cpu_count()
+show_plots = True
+
 # Function to read data from a text file
 def read_data(file_path):
     with open(file_path, 'r') as file:
         data = file.read().splitlines()
     return np.array(data, dtype=float)
 
+# Function to load every training curve at once from the consolidated metrics file written by
+# experiment_of_6_spectrograms.py. Curves that only exist as per-curve text files (older runs) are
+# added from those files, and the consolidated file is updated so they are read only once
+def load_training_metrics():
+    metrics = {}
+    if os.path.exists(training_metrics_path):
+        with open(training_metrics_path) as f:
+            metrics = json.load(f)
+
+    added = False
+    for spectrogram_type in spectrogram_types:
+        for instrument in instrument_families:
+            if instrument in metrics.get(spectrogram_type, {}):
+                continue
+            loss_file = os.path.join(metrics_dir, spectrogram_type, f'{spectrogram_type}_{instrument}_loss_curve.txt')
+            acc_file = os.path.join(metrics_dir, spectrogram_type, f'{spectrogram_type}_{instrument}_acc_curve.txt')
+            if os.path.exists(loss_file) and os.path.exists(acc_file):
+                metrics.setdefault(spectrogram_type, {})[instrument] = {
+                    'loss': read_data(loss_file).tolist(),
+                    'accuracy': read_data(acc_file).tolist(),
+                }
+                added = True
+
+    if added:
+        tmp_path = training_metrics_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(metrics, f)
+        os.replace(tmp_path, training_metrics_path)
+    return metrics
+
 def format_label(label):
     # Replace underscores with spaces
     label = label.replace('_', ' ')
@@ -203,8 +256,12 @@ def format_label(label):
     formatted_label = label.title()
     return formatted_label
 
-# Function to plot and save training curves for a specific instrument
-def plot_training_curves(instrument):
+def use_agg_backend():
+    plt.switch_backend('Agg')
+
+# Function to plot and save training curves for a specific instrument (runs in a worker process).
+# curves maps spectrogram type to {'loss': [...], 'accuracy': [...]}
+def plot_training_curves(instrument, curves, plot_path):
     num_plots = len(spectrogram_types) * 2  # Two plots per spectrogram type (loss and accuracy)
     num_cols = 4  # Four plots per row
     num_rows = (num_plots + num_cols - 1) // num_cols  # Calculate the number of rows needed
@@ -216,9 +273,6 @@ def plot_training_curves(instrument):
     plot_index = 0
 
     for i, spectrogram_type in enumerate(spectrogram_types):
-        loss_file = os.path.join(metrics_dir, spectrogram_type, f'{spectrogram_type}_{instrument}_loss_curve.txt')
-        acc_file = os.path.join(metrics_dir, spectrogram_type, f'{spectrogram_type}_{instrument}_acc_curve.txt')
-
         if spectrogram_type == 'all_combined_with_padding':
             row, col = divmod(plot_index, num_cols)
             ax_loss = fig.add_subplot(gs[row, col:col+2])
@@ -230,16 +284,13 @@ def plot_training_curves(instrument):
             ax_acc = fig.add_subplot(gs[row, col + 1])
             plot_index += 2  # Skip next 2 cells
 
-        if os.path.exists(loss_file) and os.path.exists(acc_file):
-            loss_data = read_data(loss_file)
-            acc_data = read_data(acc_file)
-
-            ax_loss.plot(loss_data)
+        if spectrogram_type in curves:
+            ax_loss.plot(curves[spectrogram_type]['loss'])
             ax_loss.set_title(f'{spectrogram_type} Loss Curve')
             ax_loss.set_xlabel('Epochs')
             ax_loss.set_ylabel('Loss')
 
-            ax_acc.plot(acc_data)
+            ax_acc.plot(curves[spectrogram_type]['accuracy'])
             ax_acc.set_title(f'{spectrogram_type} Accuracy Curve')
             ax_acc.set_xlabel('Epochs')
             ax_acc.set_ylabel('Accuracy')
@@ -247,13 +298,33 @@ def plot_training_curves(instrument):
             ax_loss.text(0.5, 0.5, 'File Not Found', horizontalalignment='center', verticalalignment='center', transform=ax_loss.transAxes)
             ax_acc.text(0.5, 0.5, 'File Not Found', horizontalalignment='center', verticalalignment='center', transform=ax_acc.transAxes)
 
-    plt.tight_layout(rect=[0, 0.03, 1, 0.95])  # Adjust layout to make space for the title
-    plt.subplots_adjust(top=0.95)  # Increase space above the subplots
-    plt.savefig(os.path.join(metrics_dir, f'{instrument}_training_curves.png'))
-    plt.show()
+    fig.tight_layout(rect=[0, 0.03, 1, 0.95])  # Adjust layout to make space for the title
+    fig.subplots_adjust(top=0.95)  # Increase space above the subplots
+    fig.savefig(plot_path)
+    plt.close(fig)
+    return plot_path
 
 # Plot and save training curves for each instrument
-for instrument in instrument_families:
-    plot_training_curves(instrument)
+with trace.stage('plot_training_curves'):
+    with trace.stage('load_training_metrics'):
+        training_metrics = load_training_metrics()
+
+    with trace.stage('render_plots'), ProcessPoolExecutor(max_workers=n_plot_workers, initializer=use_agg_backend) as pool:
+        futures = []
+        for instrument in instrument_families:
+            curves = {spectrogram_type: training_metrics[spectrogram_type][instrument] for spectrogram_type in spectrogram_types
+                      if instrument in training_metrics.get(spectrogram_type, {})}
+            plot_path = os.path.join(metrics_dir, f'{instrument}_training_curves.png')
+            futures.append(pool.submit(plot_training_curves, instrument, curves, plot_path))
+        plot_paths = [future.result() for future in futures]
+
+if show_plots:
+    from IPython.display import Image, display
+    for plot_path in plot_paths:
+        display(Image(filename=plot_path))
 
 print("Plotting and saving of training curves completed.")
+
+# Where the time went
+trace.summary()
+trace.close()